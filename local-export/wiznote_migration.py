@@ -5,24 +5,48 @@
 将为知笔记备份数据转换为Markdown格式
 """
 
+import io
 import os
 import sys
+import codecs
 import sqlite3
 import zipfile
 import json
 import re
+import html
 import shutil
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 from datetime import datetime
 from typing import Dict, List, Tuple, Optional
 import logging
 from dataclasses import dataclass
+from functools import lru_cache
 import html2text
 from bs4 import BeautifulSoup
 import base64
 import mimetypes
 from urllib.parse import unquote
 
+try:
+    import orjson
+except ImportError:  # 未安装orjson时回退到标准库json
+    orjson = None
+
+try:
+    import lxml  # noqa: F401
+    _HTML_PARSER = 'lxml'
+except ImportError:  # 未安装lxml时回退到纯Python解析器
+    _HTML_PARSER = 'html.parser'
+
+try:
+    from markdownify import MarkdownConverter
+except ImportError:  # 未安装markdownify时只能使用html2text
+    MarkdownConverter = None
+
 # 配置日志
 logging.basicConfig(
     level=logging.INFO,
@@ -35,6 +59,103 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+def _json_dumps(obj) -> bytes:
+    """序列化为带缩进的JSON字节串"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, ensure_ascii=False, indent=2).encode('utf-8')
+
+
+# 文件名非法字符替换表（目录名还需替换路径分隔符）
+_ILLEGAL_CHARS = '<>:"|?*\r\n'
+_FILENAME_TABLE = str.maketrans(dict.fromkeys(_ILLEGAL_CHARS, '_'))
+_PATH_COMPONENT_TABLE = str.maketrans(dict.fromkeys('/\\' + _ILLEGAL_CHARS, '_'))
+
+
+# HTML中的body开始标签、图片标签及其src属性
+_RE_BODY_OPEN = re.compile(r'<body\b', re.IGNORECASE)
+_RE_BODY_CLOSE = re.compile(r'</body\s*>', re.IGNORECASE)
+_RE_IMG_TAG = re.compile(r'<img\b', re.IGNORECASE)
+_RE_IMG_SRC = re.compile(r'<img\b[^>]*?\ssrc\s*=\s*(["\'])(.*?)\1', re.IGNORECASE | re.DOTALL)
+
+# 多进程迁移时每个任务包含的文档数
+_PROCESS_CHUNK_SIZE = 8
+
+# 顺序处理时的流水线：转换线程数和最多在途文档数
+_PIPELINE_WORKERS = 4
+_PIPELINE_DEPTH = 16
+
+# 笔记包中需要提取的图片扩展名
+_IMAGE_EXTS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')
+
+
+@lru_cache(maxsize=4096)
+def _sanitize_filename(filename: str) -> str:
+    """清理文件名，移除非法字符"""
+    # 移除非法字符
+    filename = filename.translate(_FILENAME_TABLE)
+    
+    # 限制长度
+    name, ext = os.path.splitext(filename)
+    if len(name) > 200:
+        name = name[:200]
+    
+    return name + ext
+
+
+# 只读迁移的SQLite调优：大页缓存、内存映射读取、临时表放内存
+_READONLY_PRAGMAS = (
+    'PRAGMA query_only = ON',
+    'PRAGMA cache_size = -262144',
+    'PRAGMA mmap_size = 268435456',
+    'PRAGMA temp_store = MEMORY',
+)
+
+
+def _connect_readonly(db_path: Path) -> sqlite3.Connection:
+    """以只读方式打开数据库，不支持URI只读模式时回退到普通连接"""
+    try:
+        conn = sqlite3.connect(f"{db_path.resolve().as_uri()}?mode=ro", uri=True)
+    except sqlite3.Error as e:
+        logger.debug(f"只读方式打开数据库失败，改用普通连接 {db_path}: {e}")
+        conn = sqlite3.connect(str(db_path))
+    
+    for pragma in _READONLY_PRAGMAS:
+        try:
+            conn.execute(pragma)
+        except sqlite3.Error as e:
+            logger.debug(f"设置数据库参数失败 {pragma}: {e}")
+    return conn
+
+
+class _ImageDataURLs:
+    """图片路径到 data URL 的映射
+    
+    完整路径和文件名都可以查找；只有被HTML引用到的图片才做Base64编码，每张图片最多编码一次
+    """
+    
+    def __init__(self, images: Dict[str, bytes], encode):
+        self._images = images
+        self._encode = encode
+        self._paths = {}
+        self._data_urls = {}
+        for img_path in images:
+            normalized_path = img_path.replace('\\', '/')
+            self._paths[normalized_path] = img_path
+            self._paths[os.path.basename(normalized_path)] = img_path
+    
+    def __bool__(self) -> bool:
+        return bool(self._paths)
+    
+    def get(self, key: str) -> Optional[str]:
+        img_path = self._paths.get(key)
+        if img_path is None:
+            return None
+        if img_path not in self._data_urls:
+            self._data_urls[img_path] = self._encode(self._images[img_path], img_path)
+        return self._data_urls[img_path]
+
+
 @dataclass
 class WizDocument:
     """为知笔记文档数据结构"""
@@ -72,7 +193,7 @@ class WizDataSource:
 class WizNoteMigrator:
     """为知笔记迁移主类"""
     
-    def __init__(self, source_dir: str, target_dir: str):
+    def __init__(self, source_dir: str, target_dir: str, engine: str = 'html2text'):
         self.source_dir = Path(source_dir)
         self.target_dir = Path(target_dir)
         self.data_dir = None
@@ -83,6 +204,12 @@ class WizNoteMigrator:
         self.current_source_name = "个人笔记"
         self.current_output_prefix = None
         
+        # 已确认存在的目录，避免重复mkdir
+        self._ensured_dirs = set()
+        # 各目录中已占用的文件名（casefold后，首次使用时从磁盘加载），处理重名时免去逐个尝试
+        # 按大小写不敏感比较，避免在Windows/macOS上只有大小写不同的文件名互相覆盖
+        self._dir_names = {}
+        
         # 统计信息
         self.stats = {
             'total_notes': 0,
@@ -93,20 +220,50 @@ class WizNoteMigrator:
             'failed_attachments': 0
         }
         
-        # HTML转Markdown配置
-        self.h2t = html2text.HTML2Text()
-        self.h2t.body_width = 0  # 不自动换行
-        self.h2t.unicode_snob = True
-        self.h2t.skip_internal_links = False
-        self.h2t.inline_links = True
-        self.h2t.protect_links = True
-        self.h2t.wrap_links = False
+        # HTML转Markdown实例按线程创建（HTML2Text带有解析状态，不能跨线程共享）
+        self._h2t_tls = threading.local()
+        
+        # 可选markdownify引擎，转换更快但输出格式与html2text略有差异
+        self.engine = engine
+        self.md_converter = None
+        if engine == 'markdownify':
+            if MarkdownConverter is None:
+                logger.warning("未安装markdownify，改用html2text转换")
+                self.engine = 'html2text'
+            else:
+                self.md_converter = MarkdownConverter(heading_style='ATX', bullets='*')
         
         # 若误传为文件路径，则退回到其父目录
         if self.target_dir.suffix.lower() == '.md':
             logger.warning(f"目标路径为文件，将使用其父目录: {self.target_dir.parent}")
             self.target_dir = self.target_dir.parent
         
+    def _names_in(self, directory: Path) -> set:
+        """获取目录中已占用的文件名集合（casefold后的名称）"""
+        key = str(directory)
+        names = self._dir_names.get(key)
+        if names is None:
+            try:
+                names = {entry.casefold() for entry in os.listdir(directory)}
+            except FileNotFoundError:
+                names = set()
+            self._dir_names[key] = names
+        return names
+    
+    def _get_h2t(self) -> html2text.HTML2Text:
+        """获取当前线程的html2text实例（首次访问时创建并配置）"""
+        h2t = getattr(self._h2t_tls, 'h2t', None)
+        if h2t is None:
+            h2t = html2text.HTML2Text()
+            h2t.body_width = 0  # 不自动换行
+            h2t.unicode_snob = True
+            h2t.skip_internal_links = False
+            h2t.inline_links = True
+            h2t.protect_links = True
+            h2t.wrap_links = False
+            self._h2t_tls.h2t = h2t
+        return h2t
+    
     def find_user_data(self) -> bool:
         """查找用户数据目录"""
         # 查找邮箱目录（通常是第一个目录）
@@ -173,7 +330,7 @@ class WizNoteMigrator:
         """读取 WIZ_META 指定键值"""
         conn = None
         try:
-            conn = sqlite3.connect(str(db_path))
+            conn = _connect_readonly(db_path)
             cursor = conn.cursor()
             cursor.execute("""
                 SELECT META_VALUE
@@ -197,10 +354,7 @@ class WizNoteMigrator:
         """清理单个目录名"""
         if not name:
             return "UnnamedGroup"
-        clean = name.strip().replace('/', '_').replace('\\', '_')
-        illegal_chars = '<>:"|?*\r\n'
-        for char in illegal_chars:
-            clean = clean.replace(char, '_')
+        clean = name.strip().translate(_PATH_COMPONENT_TABLE)
         clean = clean.strip().strip('.')
         if not clean:
             clean = "UnnamedGroup"
@@ -219,12 +373,20 @@ class WizNoteMigrator:
         self.target_dir.mkdir(parents=True, exist_ok=True)
         logger.info(f"创建目标目录: {self.target_dir}")
     
+    def _ensure_dir(self, path: Path):
+        """确保目录存在（每个目录只调用一次mkdir）"""
+        key = str(path)
+        if key in self._ensured_dirs:
+            return
+        path.mkdir(parents=True, exist_ok=True)
+        self._ensured_dirs.add(key)
+    
     def connect_database(self) -> sqlite3.Connection:
         """连接为知笔记数据库"""
         if not self.db_path.exists():
             raise FileNotFoundError(f"数据库文件不存在: {self.db_path}")
         
-        conn = sqlite3.connect(str(self.db_path))
+        conn = _connect_readonly(self.db_path)
         conn.row_factory = sqlite3.Row
         logger.info(f"[{self.current_source_name}] 成功连接数据库")
         return conn
@@ -263,21 +425,23 @@ class WizNoteMigrator:
             )
             documents.append(doc)
         
-        # 获取标签信息
+        # 获取标签信息（一次查询所有文档的标签）
+        cursor.execute("""
+            SELECT dt.DOCUMENT_GUID, t.TAG_NAME
+            FROM WIZ_DOCUMENT_TAG dt
+            JOIN WIZ_TAG t ON dt.TAG_GUID = t.TAG_GUID
+        """)
+        tags_by_guid: Dict[str, List[str]] = {}
+        for row in cursor:
+            tags_by_guid.setdefault(row['DOCUMENT_GUID'], []).append(row['TAG_NAME'])
         for doc in documents:
-            cursor.execute("""
-                SELECT t.TAG_NAME
-                FROM WIZ_DOCUMENT_TAG dt
-                JOIN WIZ_TAG t ON dt.TAG_GUID = t.TAG_GUID
-                WHERE dt.DOCUMENT_GUID = ?
-            """, (doc.guid,))
-            doc.tags = [row['TAG_NAME'] for row in cursor.fetchall()]
+            doc.tags = tags_by_guid.get(doc.guid, [])
         
         logger.info(f"获取到 {len(documents)} 个文档")
         return documents
     
-    def get_document_attachments(self, conn: sqlite3.Connection, doc_guid: str) -> List[WizAttachment]:
-        """获取文档的附件信息"""
+    def get_all_attachments(self, conn: sqlite3.Connection) -> Dict[str, List[WizAttachment]]:
+        """获取所有附件信息，按文档GUID分组"""
         cursor = conn.cursor()
         cursor.execute("""
             SELECT 
@@ -286,18 +450,17 @@ class WizNoteMigrator:
                 ATTACHMENT_NAME,
                 ATTACHMENT_DATA_MD5
             FROM WIZ_DOCUMENT_ATTACHMENT
-            WHERE DOCUMENT_GUID = ?
-        """, (doc_guid,))
+        """)
         
-        attachments = []
-        for row in cursor.fetchall():
+        attachments: Dict[str, List[WizAttachment]] = {}
+        for row in cursor:
             att = WizAttachment(
                 guid=row['ATTACHMENT_GUID'],
                 document_guid=row['DOCUMENT_GUID'],
                 name=row['ATTACHMENT_NAME'],
                 data_md5=row['ATTACHMENT_DATA_MD5']
             )
-            attachments.append(att)
+            attachments.setdefault(att.document_guid, []).append(att)
         
         return attachments
     
@@ -306,36 +469,34 @@ class WizNoteMigrator:
         # 为知笔记文件名格式是 {GUID}
         note_filename = f"{{{doc_guid}}}"
         note_path = self.notes_dir / note_filename
-        if not note_path.exists():
+        try:
+            # 笔记包通常很小，一次读入内存后再解压
+            data = note_path.read_bytes()
+        except FileNotFoundError:
             logger.warning(f"笔记文件不存在: {note_path}")
             return None, {}
+        except OSError as e:
+            logger.error(f"读取笔记失败 {doc_guid}: {e}")
+            return None, {}
         
         html_content = None
         images = {}
         
         try:
-            with zipfile.ZipFile(note_path, 'r') as zf:
-                # 查找index.html文件和图片文件
-                for filename in zf.namelist():
-                    if filename.endswith('index.html'):
-                        with zf.open(filename) as f:
-                            # 尝试不同的编码
-                            content = f.read()
-                            for encoding in ['utf-8', 'utf-16-le', 'gbk', 'gb2312']:
-                                try:
-                                    html_content = content.decode(encoding)
-                                    break
-                                except UnicodeDecodeError:
-                                    continue
-                            
-                            # 如果都失败，使用错误处理
-                            if html_content is None:
-                                html_content = content.decode('utf-8', errors='ignore')
-                    
-                    # 提取图片文件
-                    elif any(filename.lower().endswith(ext) for ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp']):
-                        with zf.open(filename) as f:
-                            images[filename] = f.read()
+            with zipfile.ZipFile(io.BytesIO(data), 'r') as zf:
+                # 一次性划分index.html和图片文件
+                names = zf.namelist()
+                html_names = [name for name in names if name.endswith('index.html')]
+                image_names = [name for name in names
+                               if not name.endswith('index.html') and name.lower().endswith(_IMAGE_EXTS)]
+                
+                if html_names:
+                    # 多个index.html时以最后一个为准
+                    html_content = self._decode_html(zf.read(html_names[-1]))
+                
+                # 提取图片文件
+                for name in image_names:
+                    images[name] = zf.read(name)
                             
         except Exception as e:
             logger.error(f"解压笔记失败 {doc_guid}: {e}")
@@ -343,55 +504,121 @@ class WizNoteMigrator:
         
         return html_content, images
     
+    @staticmethod
+    def _decode_html(content: bytes) -> str:
+        """按BOM和常见编码解码index.html"""
+        # UTF-16 LE的BOM不是合法UTF-8，直接解码省去异常回退
+        if content.startswith(codecs.BOM_UTF16_LE):
+            return content.decode('utf-16-le')
+        for encoding in ('utf-8', 'utf-16-le', 'gbk', 'gb2312'):
+            try:
+                return content.decode(encoding)
+            except UnicodeDecodeError:
+                continue
+        
+        # 如果都失败，使用错误处理
+        return content.decode('utf-8', errors='ignore')
+    
     def html_to_markdown(self, html_content: str, doc: WizDocument, images: Dict[str, bytes]) -> str:
         """将HTML内容转换为Markdown"""
         if not html_content:
             return ""
         
-        # 解析HTML
-        soup = BeautifulSoup(html_content, 'html.parser')
-        
-        # 提取body内容
-        body = soup.find('body')
-        if not body:
-            body = soup
-        
         # 构建图片 data URL 映射（不落盘）
         image_data_urls = self.build_image_data_urls(images)
         
-        # 处理HTML中的图片引用
-        for img in body.find_all('img'):
-            src = (img.get('src') or '').strip()
-            if not src:
-                continue
-            
-            # 已经是 data URL 的图片直接保留
-            if src.startswith('data:'):
-                continue
-            
-            # 处理本地图片引用，替换为 data URL
-            src_unquoted = unquote(src).replace('\\', '/')
-            src_unquoted = src_unquoted.split('?', 1)[0].split('#', 1)[0]
-            candidates = [src_unquoted, os.path.basename(src_unquoted)]
-            replaced = False
-            for key in candidates:
-                data_url = image_data_urls.get(key)
-                if data_url:
-                    img['src'] = data_url
-                    replaced = True
-                    break
-            
-            if not replaced and image_data_urls:
-                logger.warning(f"未找到图片数据: {src}")
+        # 直接在原始HTML上替换图片地址，省去BeautifulSoup解析和序列化
+        html_for_markdown = self._rewrite_img_src(html_content, image_data_urls)
+        if html_for_markdown is None:
+            html_for_markdown = self._rewrite_img_src_with_soup(html_content, image_data_urls)
         
         # 转换为Markdown
-        markdown_content = self.h2t.handle(str(body))
+        if self.md_converter is not None:
+            # 只转换body，与html2text忽略head内容的行为一致
+            soup = BeautifulSoup(html_for_markdown, _HTML_PARSER)
+            markdown_content = self.md_converter.convert_soup(soup.body or soup)
+        else:
+            markdown_content = self._get_h2t().handle(html_for_markdown)
         markdown_content = self.unescape_list_markers(markdown_content)
         markdown_content = self.normalize_blank_lines(markdown_content)
         
         # 不添加元数据，直接返回内容
         return markdown_content
 
+    def _resolve_image_src(self, src: str, image_data_urls: '_ImageDataURLs') -> Optional[str]:
+        """查找图片引用对应的 data URL，无需替换时返回None"""
+        # 已经是 data URL 的图片直接保留
+        if not src or src.startswith('data:'):
+            return None
+        
+        # 处理本地图片引用，替换为 data URL
+        src_unquoted = unquote(src).replace('\\', '/')
+        src_unquoted = src_unquoted.split('?', 1)[0].split('#', 1)[0]
+        for key in (src_unquoted, os.path.basename(src_unquoted)):
+            data_url = image_data_urls.get(key)
+            if data_url:
+                return data_url
+        
+        if image_data_urls:
+            logger.warning(f"未找到图片数据: {src}")
+        return None
+    
+    def _rewrite_img_src(self, html_content: str, 
+                         image_data_urls: '_ImageDataURLs') -> Optional[str]:
+        """用正则替换图片地址，存在无法识别的img标签时返回None"""
+        # 与BeautifulSoup路径一致，只转换body部分（排除BOM、body外的内容等）
+        body_start = _RE_BODY_OPEN.search(html_content)
+        if body_start:
+            # 与soup.find('body')一致，截止到第一个body结束标签
+            body_close = _RE_BODY_CLOSE.search(html_content, body_start.end())
+            body_end = body_close.start() if body_close else len(html_content)
+            if _RE_BODY_OPEN.search(html_content, body_start.end(), body_end):
+                # 嵌套的body标签交给BeautifulSoup处理
+                return None
+            html_content = html_content[body_start.start():body_end]
+        
+        matches = list(_RE_IMG_SRC.finditer(html_content))
+        if len(matches) != len(_RE_IMG_TAG.findall(html_content)):
+            return None
+        
+        parts = []
+        last = 0
+        for match in matches:
+            data_url = self._resolve_image_src(
+                html.unescape(match.group(2)).strip(),
+                image_data_urls
+            )
+            if data_url:
+                parts.append(html_content[last:match.start(2)])
+                parts.append(data_url)
+                last = match.end(2)
+        if not parts:
+            return html_content
+        parts.append(html_content[last:])
+        return ''.join(parts)
+    
+    def _rewrite_img_src_with_soup(self, html_content: str, 
+                                   image_data_urls: '_ImageDataURLs') -> str:
+        """通过BeautifulSoup替换图片地址"""
+        # 解析HTML
+        soup = BeautifulSoup(html_content, _HTML_PARSER)
+        
+        # 提取body内容
+        body = soup.find('body')
+        if not body:
+            body = soup
+        
+        # 处理HTML中的图片引用
+        for img in body.find_all('img'):
+            data_url = self._resolve_image_src(
+                (img.get('src') or '').strip(),
+                image_data_urls
+            )
+            if data_url:
+                img['src'] = data_url
+        
+        return str(body)
+    
     def unescape_list_markers(self, text: str) -> str:
         """恢复被转义的列表符号与分割线"""
         if not text:
@@ -442,17 +669,9 @@ class WizNoteMigrator:
             out.append(line)
         return "\n".join(out).rstrip() + "\n"
     
-    def build_image_data_urls(self, images: Dict[str, bytes]) -> Dict[str, str]:
-        """将图片二进制转换为 data URL 映射"""
-        image_data_urls = {}
-        for img_path, img_data in images.items():
-            data_url = self.image_bytes_to_data_url(img_data, img_path)
-            if not data_url:
-                continue
-            normalized_path = img_path.replace('\\', '/')
-            image_data_urls[normalized_path] = data_url
-            image_data_urls[os.path.basename(normalized_path)] = data_url
-        return image_data_urls
+    def build_image_data_urls(self, images: Dict[str, bytes]) -> '_ImageDataURLs':
+        """将图片二进制转换为 data URL 映射（按需编码）"""
+        return _ImageDataURLs(images, self.image_bytes_to_data_url)
     
     def image_bytes_to_data_url(self, img_data: bytes, img_path: str) -> Optional[str]:
         """将图片二进制转换为 data URL"""
@@ -468,6 +687,12 @@ class WizNoteMigrator:
     
     def get_document_dir(self, doc: WizDocument) -> Path:
         """获取文档的目标目录"""
+        doc_dir = self._document_dir_path(doc)
+        self._ensure_dir(doc_dir)
+        return doc_dir
+    
+    def _document_dir_path(self, doc: WizDocument) -> Path:
+        """计算文档的目标目录（不创建）"""
         # 将路径转换为合法的目录名
         location = doc.location.strip('/')
         if not location:
@@ -476,50 +701,53 @@ class WizNoteMigrator:
         # 替换路径分隔符
         location = location.replace('/', os.sep)
         
-        # 创建目录
         if self.current_output_prefix is None:
-            doc_dir = self.target_dir / location
-        else:
-            doc_dir = self.target_dir / self.current_output_prefix / location
-        doc_dir.mkdir(parents=True, exist_ok=True)
-        
-        return doc_dir
+            return self.target_dir / location
+        return self.target_dir / self.current_output_prefix / location
     
     def sanitize_filename(self, filename: str) -> str:
         """清理文件名，移除非法字符"""
-        # 移除非法字符
-        illegal_chars = '<>:"|?*\r\n'
-        for char in illegal_chars:
-            filename = filename.replace(char, '_')
+        return _sanitize_filename(filename)
+    
+    def assign_document_filename(self, doc: WizDocument) -> str:
+        """为文档分配不重名的文件名
         
-        # 限制长度
-        name, ext = os.path.splitext(filename)
-        if len(name) > 200:
-            name = name[:200]
+        在分发任务前按文档顺序调用，重名文档的编号与处理顺序无关
+        """
+        filename = self.sanitize_filename(doc.title)
+        if not filename.endswith('.md'):
+            filename += '.md'
         
-        return name + ext
+        return self._reserve_filename(self._document_dir_path(doc), filename)
+    
+    def _reserve_filename(self, directory: Path, filename: str) -> str:
+        """跳过目录中已有和已分配的名称（忽略大小写），返回并占用可用的文件名"""
+        names = self._names_in(directory)
+        name, ext = os.path.splitext(filename)
+        counter = 1
+        while filename.casefold() in names:
+            filename = f"{name}_{counter}{ext}"
+            counter += 1
+        names.add(filename.casefold())
+        return filename
     
-    def save_document(self, doc: WizDocument, content: str) -> bool:
-        """保存文档为Markdown文件"""
+    def save_document(self, doc: WizDocument, content: str, filename: str) -> bool:
+        """保存文档为Markdown文件（文件名由assign_document_filename预先分配）"""
         try:
             doc_dir = self.get_document_dir(doc)
             
-            # 生成文件名
-            filename = self.sanitize_filename(doc.title)
-            if not filename.endswith('.md'):
-                filename += '.md'
-            
-            filepath = doc_dir / filename
-            
-            # 处理重名
-            counter = 1
-            while filepath.exists():
-                name, ext = os.path.splitext(filename)
-                filepath = doc_dir / f"{name}_{counter}{ext}"
-                counter += 1
+            # 独占方式创建；名称集合未覆盖的冲突不会覆盖已有文件，而是改用下一个编号
+            while True:
+                filepath = doc_dir / filename
+                try:
+                    f = open(filepath, 'x', encoding='utf-8')
+                    break
+                except FileExistsError:
+                    self._names_in(doc_dir).add(filename.casefold())
+                    filename = self._reserve_filename(doc_dir, filename)
             
             block = self.format_document_block(doc, content)
-            with open(filepath, 'w', encoding='utf-8') as f:
+            with f:
                 f.write(block)
             
             logger.info(f"保存文档: {filepath}")
@@ -557,12 +785,12 @@ class WizNoteMigrator:
             # 目标路径
             doc_dir = self.get_document_dir(doc)
             assets_dir = doc_dir / 'assets'
-            assets_dir.mkdir(parents=True, exist_ok=True)
+            self._ensure_dir(assets_dir)
             
             target_file = assets_dir / attachment.name
             
-            # 复制文件
-            shutil.copy2(source_file, target_file)
+            # 复制文件内容（不保留元数据，Linux下走sendfile零拷贝）
+            shutil.copyfile(source_file, target_file)
             logger.info(f"复制附件: {attachment.name}")
             return True
             
@@ -588,44 +816,146 @@ class WizNoteMigrator:
             documents = self.get_all_documents(conn)
             self.stats['total_notes'] += len(documents)
 
-            # 迁移每个文档
-            for i, doc in enumerate(documents, 1):
-                logger.info(f"[{source.source_name}] 处理文档 {i}/{len(documents)}: {doc.title}")
-
-                # 提取内容和图片
-                html_content, images = self.extract_note_content(doc.guid)
-                if not html_content:
-                    self.stats['failed_notes'] += 1
-                    continue
-
-                # 转换为Markdown
-                markdown_content = self.html_to_markdown(html_content, doc, images)
-
-                # 保存文档
-                if self.save_document(doc, markdown_content):
-                    self.stats['migrated_notes'] += 1
-                else:
-                    self.stats['failed_notes'] += 1
-                    continue
-
-                # 处理附件（图片附件跳过）
-                if doc.attachment_count > 0:
-                    attachments = self.get_document_attachments(conn, doc.guid)
-                    self.stats['total_attachments'] += len(attachments)
-                    if not self.attachments_dir:
-                        continue
-
-                    for att in attachments:
-                        if self.is_image_file(att.name):
-                            logger.info(f"[{source.source_name}] 跳过图片附件: {att.name}")
-                            continue
-                        if self.copy_attachment(doc, att):
-                            self.stats['migrated_attachments'] += 1
-                        else:
-                            self.stats['failed_attachments'] += 1
+            # 迁移每个文档（附件信息和文件名在主进程中按文档顺序确定）
+            attachments = self.get_all_attachments(conn)
+            try:
+                note_files = set(os.listdir(self.notes_dir))
+            except OSError:
+                note_files = set()
+            tasks = [
+                (i, len(documents), doc,
+                 attachments.get(doc.guid, []) if doc.attachment_count > 0 else [],
+                 # 笔记文件缺失的文档必然失败，不占用文件名
+                 self.assign_document_filename(doc) if f"{{{doc.guid}}}" in note_files else None)
+                for i, doc in enumerate(documents, 1)
+            ]
+            for result in self._migrate_documents(source, tasks):
+                for key, value in result.items():
+                    self.stats[key] += value
         finally:
             conn.close()
     
+    def _migrate_documents(self, source: WizDataSource, tasks: List[Tuple]) -> List[Dict[str, int]]:
+        """并行迁移文档，返回每个文档的统计增量
+        
+        文档之间相互独立，按分块使用多进程处理；进程池不可用时，未确认完成的分块在当前进程中流水线处理
+        """
+        if len(tasks) <= 1:
+            return self._migrate_pipelined(tasks)
+        
+        chunks = [tasks[i:i + _PROCESS_CHUNK_SIZE] for i in range(0, len(tasks), _PROCESS_CHUNK_SIZE)]
+        futures = []
+        try:
+            with ProcessPoolExecutor(
+                max_workers=os.cpu_count(),
+                initializer=_init_migration_worker,
+                initargs=(str(self.source_dir), str(self.target_dir), self.engine, source)
+            ) as executor:
+                futures = [executor.submit(_migrate_chunk_in_worker, chunk) for chunk in chunks]
+                results = []
+                for future in futures:
+                    results.extend(future.result())
+            return results
+        except (OSError, NotImplementedError, BrokenProcessPool) as e:
+            logger.warning(f"多进程迁移不可用，未完成的文档改为顺序处理: {e}")
+        
+        # 已成功返回的分块保留结果，其余分块重新处理
+        results = []
+        remaining = []
+        for index, chunk in enumerate(chunks):
+            future = futures[index] if index < len(futures) else None
+            if (future is not None and future.done() and not future.cancelled()
+                    and future.exception() is None):
+                results.extend(future.result())
+            else:
+                remaining.extend(chunk)
+        
+        # 中断的工作进程可能已写入部分文档；这些文件名由本次运行分配且分配时不存在，
+        # 先删除再重新处理，避免独占创建时生成重复的编号文件
+        if futures:
+            for task in remaining:
+                filename = task[4]
+                if filename is not None:
+                    (self._document_dir_path(task[2]) / filename).unlink(missing_ok=True)
+        
+        results.extend(self._migrate_pipelined(remaining))
+        return results
+    
+    def _migrate_pipelined(self, tasks: List[Tuple]) -> List[Dict[str, int]]:
+        """线程池提前解压和转换后续文档，当前线程按原顺序写入，在途文档数有上限"""
+        results = []
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=_PIPELINE_WORKERS) as executor:
+            for task in tasks:
+                pending.append((task, executor.submit(self.convert_document, task[2])))
+                if len(pending) >= _PIPELINE_DEPTH:
+                    results.append(self._write_task(*pending.popleft()))
+            while pending:
+                results.append(self._write_task(*pending.popleft()))
+        return results
+    
+    def _write_task(self, task: Tuple, future) -> Dict[str, int]:
+        """等待文档转换完成后写入文档及附件"""
+        i, total, doc, attachments, filename = task
+        logger.info(f"[{self.current_source_name}] 处理文档 {i}/{total}: {doc.title}")
+        return self.write_document(doc, future.result(), attachments, filename)
+    
+    def migrate_task(self, task: Tuple) -> Dict[str, int]:
+        """处理单个迁移任务 (序号, 总数, 文档, 附件列表, 文件名)"""
+        i, total, doc, attachments, filename = task
+        logger.info(f"[{self.current_source_name}] 处理文档 {i}/{total}: {doc.title}")
+        return self.migrate_document(doc, attachments, filename)
+    
+    def migrate_document(self, doc: WizDocument, attachments: List[WizAttachment],
+                         filename: Optional[str]) -> Dict[str, int]:
+        """迁移单个文档及其附件，返回统计增量"""
+        return self.write_document(doc, self.convert_document(doc), attachments, filename)
+    
+    def convert_document(self, doc: WizDocument) -> Optional[str]:
+        """提取并转换文档内容，笔记无法读取时返回None"""
+        html_content, images = self.extract_note_content(doc.guid)
+        if not html_content:
+            return None
+        return self.html_to_markdown(html_content, doc, images)
+    
+    def write_document(self, doc: WizDocument, markdown_content: Optional[str],
+                       attachments: List[WizAttachment], filename: Optional[str]) -> Dict[str, int]:
+        """保存转换后的文档及其附件，返回统计增量"""
+        stats = dict.fromkeys((
+            'migrated_notes',
+            'failed_notes',
+            'total_attachments',
+            'migrated_attachments',
+            'failed_attachments'
+        ), 0)
+        
+        if markdown_content is None or filename is None:
+            stats['failed_notes'] += 1
+            return stats
+        
+        # 保存文档
+        if self.save_document(doc, markdown_content, filename):
+            stats['migrated_notes'] += 1
+        else:
+            stats['failed_notes'] += 1
+            return stats
+        
+        # 处理附件（图片附件跳过）
+        stats['total_attachments'] += len(attachments)
+        if not self.attachments_dir:
+            return stats
+        
+        for att in attachments:
+            if self.is_image_file(att.name):
+                logger.info(f"[{self.current_source_name}] 跳过图片附件: {att.name}")
+                continue
+            if self.copy_attachment(doc, att):
+                stats['migrated_attachments'] += 1
+            else:
+                stats['failed_attachments'] += 1
+        
+        return stats
+    
     def migrate(self):
         """执行迁移"""
         logger.info("开始迁移为知笔记...")
@@ -672,16 +1002,14 @@ class WizNoteMigrator:
                 'tags': doc.tags
             })
         
-        with open(metadata_dir / 'index.json', 'w', encoding='utf-8') as f:
-            json.dump(index_data, f, ensure_ascii=False, indent=2)
+        (metadata_dir / 'index.json').write_bytes(_json_dumps(index_data))
         
         # 保存标签列表
         all_tags = set()
         for doc in documents:
             all_tags.update(doc.tags)
         
-        with open(metadata_dir / 'tags.json', 'w', encoding='utf-8') as f:
-            json.dump(sorted(list(all_tags)), f, ensure_ascii=False, indent=2)
+        (metadata_dir / 'tags.json').write_bytes(_json_dumps(sorted(all_tags)))
         
         logger.info("元数据保存完成")
     
@@ -700,20 +1028,40 @@ class WizNoteMigrator:
         print("="*50)
 
 
+# 迁移工作进程中的迁移器实例
+_worker_migrator = None
+
+
+def _init_migration_worker(source_dir: str, target_dir: str, engine: str, source: WizDataSource):
+    """初始化迁移工作进程"""
+    global _worker_migrator
+    _worker_migrator = WizNoteMigrator(source_dir, target_dir, engine)
+    _worker_migrator.set_active_source(source)
+
+
+def _migrate_chunk_in_worker(tasks: List[Tuple]) -> List[Dict[str, int]]:
+    """在工作进程中迁移一个分块的文档"""
+    return [_worker_migrator.migrate_task(task) for task in tasks]
+
+
 def main():
     """主函数"""
-    if len(sys.argv) < 2:
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if not args:
         print("使用方法:")
-        print("  python wiznote_migration.py <源目录> [目标目录]")
+        print("  python wiznote_migration.py <源目录> [目标目录] [--markdownify]")
+        print("\n选项:")
+        print("  --markdownify  使用markdownify转换HTML（需安装markdownify，速度更快）")
         print("\n示例:")
         print("  python wiznote_migration.py ./wiznote ./notes")
         sys.exit(1)
     
-    source_dir = sys.argv[1]
-    target_dir = sys.argv[2] if len(sys.argv) > 2 else "notes"
+    source_dir = args[0]
+    target_dir = args[1] if len(args) > 1 else "notes"
+    engine = 'markdownify' if '--markdownify' in sys.argv[1:] else 'html2text'
     
     # 创建迁移器并执行
-    migrator = WizNoteMigrator(source_dir, target_dir)
+    migrator = WizNoteMigrator(source_dir, target_dir, engine)
     
     try:
         migrator.migrate()
@@ -5,29 +5,38 @@
 主程序入口
 """
 
+from __future__ import annotations
+
 import os
 import sys
 import json
 import logging
+import logging.handlers
 import argparse
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import Optional, List
+from typing import TYPE_CHECKING, Optional, List
+
+try:
+    import orjson
+except ImportError:  # 未安装orjson时回退到标准库json
+    orjson = None
 
 # 添加src目录到Python路径
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'src'))
 
-from auth import WizNoteAuth
-from api_client import WizNoteAPIClient
-from storage import LocalStorage
-from downloader import NoteDownloader
-from converter import HTMLToMarkdownConverter
+# 业务模块在main()中按需导入，--help 等快速退出的路径无需加载 requests/bs4 等依赖
+if TYPE_CHECKING:
+    from auth import WizNoteAuth
+    from api_client import WizNoteAPIClient
+    from downloader import NoteDownloader
 
 
 def setup_logging(config: dict):
     """设置日志"""
     log_level = getattr(logging, config['logging']['level'].upper())
-    log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     
     # 创建日志目录
     log_file = config['logging']['log_file']
@@ -38,17 +47,25 @@ def setup_logging(config: dict):
     # 配置日志
     handlers = []
     
-    # 文件处理器
-    file_handler = logging.FileHandler(log_file, encoding='utf-8')
+    # 文件处理器：先缓存到内存，满1024条或遇到ERROR时批量写入
+    # 程序退出时 logging.shutdown() 会关闭并刷新缓存
+    # delay=True：直到第一条日志写入时才打开文件
+    raw_file_handler = logging.FileHandler(log_file, encoding='utf-8', delay=True)
+    raw_file_handler.setLevel(log_level)
+    raw_file_handler.setFormatter(formatter)
+    file_handler = logging.handlers.MemoryHandler(
+        capacity=1024,
+        flushLevel=logging.ERROR,
+        target=raw_file_handler
+    )
     file_handler.setLevel(log_level)
-    file_handler.setFormatter(logging.Formatter(log_format))
     handlers.append(file_handler)
     
     # 控制台处理器
     if config['logging']['console_output']:
         console_handler = logging.StreamHandler()
         console_handler.setLevel(log_level)
-        console_handler.setFormatter(logging.Formatter(log_format))
+        console_handler.setFormatter(formatter)
         handlers.append(console_handler)
     
     # 配置根日志器
@@ -60,14 +77,50 @@ def setup_logging(config: dict):
 
 def load_config(config_file: str) -> dict:
     """加载配置文件"""
-    with open(config_file, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    with open(config_file, 'rb') as f:
+        data = f.read()
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data.decode('utf-8'))
 
 
 def save_config(config: dict, config_file: str):
     """保存配置文件"""
-    with open(config_file, 'w', encoding='utf-8') as f:
-        json.dump(config, f, ensure_ascii=False, indent=4)
+    if orjson is not None:
+        data = orjson.dumps(config, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    else:
+        data = json.dumps(config, ensure_ascii=False, indent=2).encode('utf-8')
+    with open(config_file, 'wb') as f:
+        f.write(data)
+
+
+def load_manifest(manifest_file: str) -> dict:
+    """加载下载清单（记录已下载笔记的版本和本地文件信息）"""
+    if not os.path.exists(manifest_file):
+        return {}
+    
+    try:
+        return load_config(manifest_file)
+    except Exception as e:
+        logging.getLogger(__name__).warning(f"加载下载清单失败: {e}")
+        return {}
+
+
+def save_manifest(manifest: dict, manifest_file: str):
+    """原子地保存下载清单"""
+    manifest_dir = os.path.dirname(manifest_file)
+    if manifest_dir:
+        os.makedirs(manifest_dir, exist_ok=True)
+    
+    if orjson is not None:
+        data = orjson.dumps(manifest)
+    else:
+        data = json.dumps(manifest, ensure_ascii=False).encode('utf-8')
+    
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_file, manifest_file)
 
 
 def check_credentials(config: dict) -> bool:
@@ -105,22 +158,34 @@ def interactive_login(config: dict) -> bool:
     return True
 
 
-def list_folders(api_client: WizNoteAPIClient):
+def get_folders(api_client: WizNoteAPIClient,
+                folders_future: Optional[Future] = None) -> list:
+    """获取文件夹列表，优先使用后台预取的结果"""
+    if folders_future is not None:
+        return folders_future.result()
+    return api_client.get_all_folders()
+
+
+def list_folders(api_client: WizNoteAPIClient, folders_future: Optional[Future] = None):
     """列出所有文件夹"""
     print("\n您的文件夹列表：")
     print("-" * 50)
     
-    folders = api_client.get_all_folders()
+    folders = get_folders(api_client, folders_future)
     if not folders:
         print("未找到任何文件夹。")
         return
     
+    # 一次性计算 (路径, 层级, 名称)，按路径排序后显示
+    entries = [
+        (folder, folder.count('/') - 2, folder.rstrip('/').rpartition('/')[2] or 'Root')
+        for folder in folders
+    ]
+    entries.sort()
+    
     # 按层级显示文件夹
-    for folder in sorted(folders):
-        level = folder.count('/') - 2  # 计算层级
-        indent = "  " * level
-        folder_name = folder.strip('/').split('/')[-1] if folder != '/' else 'Root'
-        print(f"{indent}{folder_name} ({folder})")
+    for folder, level, folder_name in entries:
+        print(f"{'  ' * level}{folder_name} ({folder})")
 
 
 def list_knowledge_bases(auth: WizNoteAuth):
@@ -161,6 +226,17 @@ def incremental_backup(downloader: NoteDownloader):
     downloader.download_all()
 
 
+def positive_int(value: str) -> int:
+    """argparse类型：正整数"""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"不是有效的整数: {value}")
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"必须为正整数: {value}")
+    return number
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='为知笔记备份工具',
@@ -184,6 +260,9 @@ def main():
   
   # 使用自定义配置文件
   python main.py --config my_config.json --all
+  
+  # 使用10个并发下载
+  python main.py --all --parallel 10
         """
     )
     
@@ -239,6 +318,12 @@ def main():
         help='指定输出目录'
     )
     
+    parser.add_argument(
+        '--parallel',
+        type=positive_int,
+        help='并发请求数（团队知识库获取和笔记下载，默认使用配置文件中的值）'
+    )
+    
     parser.add_argument(
         '--login',
         action='store_true',
@@ -285,12 +370,17 @@ def main():
     if args.incremental:
         config['sync']['incremental'] = True
     
+    if args.parallel is not None:
+        config['api']['parallel'] = args.parallel
+        config['download']['max_concurrent'] = args.parallel
+    
     # 检查凭据
     if not args.login and not check_credentials(config):
         if not interactive_login(config):
             return
     
     # 创建认证管理器
+    from auth import WizNoteAuth
     auth = WizNoteAuth(config)
     
     # 登录
@@ -327,28 +417,45 @@ def main():
         print(f"\n使用知识库: {current_kb_name}")
     
     # 创建API客户端
+    from api_client import WizNoteAPIClient
     api_client = WizNoteAPIClient(auth, config)
     
+    # 列出文件夹或进入交互菜单时，在后台提前获取文件夹列表
+    folders_future = None
+    interactive = not (args.folders or args.all or args.incremental)
+    if args.list or (interactive and sys.stdin.isatty()):
+        prefetch_executor = ThreadPoolExecutor(max_workers=1)
+        folders_future = prefetch_executor.submit(api_client.get_all_folders)
+        prefetch_executor.shutdown(wait=False)
+    
     # 列出文件夹
     if args.list:
-        list_folders(api_client)
+        list_folders(api_client, folders_future)
         return
     
     # 创建存储管理器
+    from storage import LocalStorage
     storage = LocalStorage(
         config['download']['output_dir'],
-        config['format']['preserve_structure']
+        config['format']['preserve_structure'],
+        config['sync'].get('md_cache_size', 5000)
     )
     
     # 创建转换器
     converter = None
     if config['format']['convert_to_markdown']:
+        from converter import HTMLToMarkdownConverter
         converter = HTMLToMarkdownConverter(config)
     
     # 创建下载器
+    from downloader import NoteDownloader
     downloader = NoteDownloader(api_client, storage, converter)
     downloader.set_kb_name(current_kb_name)  # 设置知识库名称
     
+    # 加载下载清单，增量备份时跳过未变化的笔记
+    manifest_file = config['sync'].get('manifest_file', 'config/manifest.json')
+    downloader.set_manifest(load_manifest(manifest_file))
+    
     # 执行备份
     if args.folders:
         backup_specific_folders(downloader, args.folders)
@@ -368,7 +475,7 @@ def main():
         if choice == '1':
             backup_all(downloader)
         elif choice == '2':
-            folders = api_client.get_all_folders()
+            folders = get_folders(api_client, folders_future)
             if not folders:
                 print("未找到任何文件夹。")
                 return
@@ -389,7 +496,7 @@ def main():
                 else:
                     print("未选择有效的文件夹。")
         elif choice == '3':
-            list_folders(api_client)
+            list_folders(api_client, folders_future)
         elif choice == '4':
             config['sync']['incremental'] = True
             incremental_backup(downloader)
@@ -399,7 +506,11 @@ def main():
         else:
             print("无效的选项。")
     
+    # 保存下载清单
+    save_manifest(downloader.manifest, manifest_file)
+    
     # 清理
+    storage.close()
     logger.info("备份任务完成。")
 
 
@@ -9,7 +9,7 @@ import os
 import json
 import time
 import requests
-from typing import Dict, List, Optional, Generator
+from typing import Dict, List, Optional, Generator, Iterator, Union
 from functools import wraps
 import logging
 from tenacity import retry, stop_after_attempt, wait_exponential
@@ -37,6 +37,28 @@ def rate_limit(calls_per_second: int = 10):
     return decorator
 
 
+class _ResponseChunks:
+    """响应数据块迭代器，读完、读取出错或调用close时关闭响应，释放连接池中的连接"""
+    
+    def __init__(self, response: requests.Response, chunk_size: int):
+        self._response = response
+        self._chunks = response.iter_content(chunk_size=chunk_size)
+    
+    def __iter__(self):
+        return self
+    
+    def __next__(self) -> bytes:
+        try:
+            return next(self._chunks)
+        except BaseException:
+            # 包括StopIteration：迭代结束即关闭
+            self.close()
+            raise
+    
+    def close(self):
+        self._response.close()
+
+
 class WizNoteAPIClient:
     """为知笔记API客户端"""
     
@@ -76,12 +98,12 @@ class WizNoteAPIClient:
         headers = self.auth.get_headers()
         
         if 'headers' in kwargs:
-            headers.update(kwargs['headers'])
-            kwargs.pop('headers')
+            # 请求头是认证模块的缓存，合并到新字典中
+            headers = {**headers, **kwargs.pop('headers')}
         
         logger.debug(f"{method} {url}")
         
-        response = requests.request(
+        response = self.auth.session.request(
             method,
             url,
             headers=headers,
@@ -95,7 +117,7 @@ class WizNoteAPIClient:
             logger.info("Token过期，刷新中...")
             self.auth.refresh_token()
             headers = self.auth.get_headers()
-            response = requests.request(
+            response = self.auth.session.request(
                 method,
                 url,
                 headers=headers,
@@ -295,10 +317,14 @@ class WizNoteAPIClient:
         
         return []
     
-    def download_attachment(self, doc_guid: str, att_guid: str) -> Optional[bytes]:
+    def download_attachment(self, doc_guid: str, att_guid: str, 
+                            stream: bool = False) -> Optional[Union[bytes, Iterator[bytes]]]:
         """下载附件
         
         官方API: GET /ks/attachment/download/:kbGuid/:docGuid/:attGuid
+        
+        stream为True时返回数据块迭代器，由调用方边读取边写入，避免整个文件驻留内存；
+        调用方未读完时需调用其close()释放连接
         """
         response = self.request(
             'GET', 
@@ -307,13 +333,18 @@ class WizNoteAPIClient:
         )
         
         if response.status_code == 200:
+            if stream:
+                return _ResponseChunks(response, self.config['download']['chunk_size'])
+            
             # 流式下载大文件
-            chunks = []
-            for chunk in response.iter_content(chunk_size=self.config['download']['chunk_size']):
-                if chunk:
-                    chunks.append(chunk)
+            with response:
+                chunks = []
+                for chunk in response.iter_content(chunk_size=self.config['download']['chunk_size']):
+                    if chunk:
+                        chunks.append(chunk)
             return b''.join(chunks)
         else:
+            response.close()
             logger.error(f"下载附件失败: HTTP {response.status_code}")
             return None
     
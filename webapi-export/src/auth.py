@@ -11,62 +11,173 @@ import json
 import time
 import hashlib
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Optional, Dict, List
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, Optional, Dict, List, Tuple
 import logging
-from cryptography.fernet import Fernet
+
+try:
+    import orjson
+except ImportError:  # 未安装orjson时回退到标准库json
+    orjson = None
+
+if TYPE_CHECKING:
+    from cryptography.fernet import Fernet
 
 logger = logging.getLogger(__name__)
 
 
+def _json_dumps(obj: Any) -> bytes:
+    """序列化为JSON字节串（orjson原生支持datetime，标准库需要转换为ISO格式）"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, default=datetime.isoformat).encode()
+
+
+def _json_loads(data: bytes) -> Any:
+    """从JSON字节串反序列化"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data.decode())
+
+
+class _LazyJSON:
+    """延迟格式化的JSON，仅在日志记录真正输出时才序列化"""
+    
+    __slots__ = ('value',)
+    
+    def __init__(self, value: Any):
+        self.value = value
+    
+    def __str__(self) -> str:
+        if orjson is not None:
+            return orjson.dumps(self.value, option=orjson.OPT_INDENT_2).decode()
+        return json.dumps(self.value, indent=2, ensure_ascii=False)
+
+
+def _read_file(path: str) -> bytes:
+    """读取密钥/Token等小文件
+
+    直接使用文件描述符读取，省去缓冲文件对象的创建，普通文件一次 read 即可读完
+    """
+    fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        size = os.fstat(fd).st_size
+        data = b''
+        while len(data) < size:
+            chunk = os.read(fd, size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+    finally:
+        os.close(fd)
+
+
+@lru_cache(maxsize=None)
+def _get_cipher(key_file: str) -> 'Fernet':
+    """按密钥文件路径缓存Fernet实例"""
+    # 延迟导入：仅在需要保存Token时才加载cryptography
+    from cryptography.fernet import Fernet
+    
+    if os.path.exists(key_file):
+        key = _read_file(key_file)
+    else:
+        key = Fernet.generate_key()
+        with open(key_file, 'wb') as f:
+            f.write(key)
+    return Fernet(key)
+
+
 class WizNoteAuth:
     """为知笔记认证管理器"""
     
     def __init__(self, config: Dict):
         self.config = config
-        self.as_url = config['api']['as_url']  # Account Server URL
-        self.username = config['auth']['username']
-        self.password = config['auth']['password']
-        self.token_file = config['auth']['token_file']
-        self.save_token = config['auth']['save_token']
+        self.as_url: str = config['api']['as_url']  # Account Server URL
+        self.username: str = config['auth']['username']
+        self.password: str = config['auth']['password']
+        self.token_file: str = config['auth']['token_file']
+        self.save_token: bool = config['auth']['save_token']
+        self._token_dir = os.path.dirname(self.token_file)
+        self._key_file = os.path.join(self._token_dir, '.key')
         
         # 认证相关信息
-        self.token = None
-        self.kb_guid = None  # 当前知识库GUID
-        self.kb_server = None  # 当前知识库服务器地址
-        self.user_guid = None
-        self.token_expiry = None
-        self.kb_list = []  # 所有知识库列表（个人+团队）
+        self.token: Optional[str] = None
+        self.kb_guid: Optional[str] = None  # 当前知识库GUID
+        self.kb_server: Optional[str] = None  # 当前知识库服务器地址
+        self.user_guid: Optional[str] = None
+        self.token_expiry: Optional[datetime] = None
+        self.kb_list: List[Dict] = []  # 所有知识库列表（个人+团队）
+        
+        # 请求头缓存，Token变化时重建
+        self._headers_cache: Optional[Dict[str, str]] = None
+        self._token_deadline: Optional[float] = None  # time.monotonic() 时间戳
+        
+        # 复用HTTP连接（认证和API客户端共用同一个会话）
+        self.session = self._create_session()
         
         # 加密密钥（实际使用时应该更安全地管理）
-        self._cipher_suite = None
+        self._cipher_suite: Optional['Fernet'] = None
         if self.save_token:
+            if self._token_dir:
+                os.makedirs(self._token_dir, exist_ok=True)
             self._init_encryption()
     
-    def _init_encryption(self):
+    def _create_session(self) -> requests.Session:
+        """创建带连接池的HTTP会话"""
+        # 附件下载线程池的大小为max_concurrent的两倍，连接池需容纳所有并发请求
+        pool_size = max(10, self.config['download'].get('max_concurrent', 5) * 2)
+        adapter = HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=self.config['api'].get('max_retries', 3),
+                backoff_factor=0.3
+            )
+        )
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update({"User-Agent": "WizNote-Team-Backup/1.0"})
+        return session
+    
+    def _update_token_cache(self) -> None:
+        """Token变化后重建请求头缓存和过期时间"""
+        # 提前5分钟过期，避免边界情况
+        remaining = (self.token_expiry - datetime.now()).total_seconds() - 5 * 60
+        self._token_deadline = time.monotonic() + remaining
+        self._headers_cache = {
+            "X-Wiz-Token": self.token,  # 根据官方文档使用X-Wiz-Token
+            "Content-Type": "application/json",
+            "User-Agent": "WizNote-Team-Backup/1.0"
+        }
+    
+    def _init_encryption(self) -> None:
         """初始化加密"""
-        key_file = os.path.join(os.path.dirname(self.token_file), '.key')
-        if os.path.exists(key_file):
-            with open(key_file, 'rb') as f:
-                key = f.read()
-        else:
-            key = Fernet.generate_key()
-            os.makedirs(os.path.dirname(key_file), exist_ok=True)
-            with open(key_file, 'wb') as f:
-                f.write(key)
-        self._cipher_suite = Fernet(key)
+        self._cipher_suite = _get_cipher(self._key_file)
     
     def _load_saved_token(self) -> bool:
-        """加载保存的Token"""
+        """加载保存的Token
+        
+        Token文件只加密 token/user_guid/expiry，知识库信息以明文保存在 .meta 文件中
+        """
         if not self.save_token or not os.path.exists(self.token_file):
             return False
         
         try:
-            with open(self.token_file, 'rb') as f:
-                encrypted_data = f.read()
+            encrypted_data = _read_file(self.token_file)
             
             decrypted_data = self._cipher_suite.decrypt(encrypted_data)
-            token_data = json.loads(decrypted_data.decode())
+            token_data = _json_loads(decrypted_data)
+            
+            # 旧版本Token文件中包含全部字段，没有 .meta 文件
+            meta_file = self.token_file + '.meta'
+            if os.path.exists(meta_file):
+                token_data.update(_json_loads(_read_file(meta_file)))
             
             # 检查是否过期
             expiry = datetime.fromisoformat(token_data['expiry'])
@@ -77,6 +188,7 @@ class WizNoteAuth:
                 self.user_guid = token_data.get('user_guid')
                 self.token_expiry = expiry
                 self.kb_list = token_data.get('kb_list', [])
+                self._update_token_cache()
                 logger.info("使用保存的Token")
                 return True
             else:
@@ -86,28 +198,30 @@ class WizNoteAuth:
             logger.error(f"加载Token失败: {e}")
             return False
     
-    def _save_token(self):
+    def _save_token(self) -> None:
         """保存Token到文件"""
         if not self.save_token or not self.token:
             return
         
         try:
+            # 只加密敏感信息
             token_data = {
                 'token': self.token,
+                'user_guid': self.user_guid,
+                'expiry': self.token_expiry
+            }
+            meta_data = {
                 'kb_guid': self.kb_guid,
                 'kb_server': self.kb_server,
-                'user_guid': self.user_guid,
-                'kb_list': self.kb_list,
-                'expiry': self.token_expiry.isoformat()
+                'kb_list': self.kb_list
             }
             
-            encrypted_data = self._cipher_suite.encrypt(
-                json.dumps(token_data).encode()
-            )
+            encrypted_data = self._cipher_suite.encrypt(_json_dumps(token_data))
             
-            os.makedirs(os.path.dirname(self.token_file), exist_ok=True)
             with open(self.token_file, 'wb') as f:
                 f.write(encrypted_data)
+            with open(self.token_file + '.meta', 'wb') as f:
+                f.write(_json_dumps(meta_data))
             
             logger.info("Token已保存")
         except Exception as e:
@@ -132,7 +246,7 @@ class WizNoteAuth:
         }
         
         try:
-            response = requests.post(
+            response = self.session.post(
                 login_url,
                 json=login_data,
                 timeout=self.config['api']['timeout']
@@ -145,29 +259,33 @@ class WizNoteAuth:
                     auth_result = result['result']
                     
                     # 调试：打印完整响应
-                    logger.debug(f"登录响应: {json.dumps(result, indent=2, ensure_ascii=False)}")
+                    logger.debug("登录响应: %s", _LazyJSON(result))
                     
                     # 检查是否有额外的团队信息
+                    preloaded_teams = None
                     if 'bizUserList' in auth_result:
                         logger.info(f"发现团队信息: {len(auth_result['bizUserList'])} 个团队")
-                        for biz_user in auth_result['bizUserList']:
-                            self.kb_list.append({
+                        preloaded_teams = [
+                            {
                                 'kbGuid': biz_user.get('kbGuid'),
                                 'kbServer': biz_user.get('kbServer'),
                                 'name': f"{biz_user.get('bizName', 'Unknown')} - 团队笔记",
                                 'type': 'team',
                                 'bizName': biz_user.get('bizName'),
                                 'bizGuid': biz_user.get('bizGuid')
-                            })
+                            }
+                            for biz_user in auth_result['bizUserList']
+                        ]
                     
                     self.token = auth_result['token']
                     self.kb_guid = auth_result['kbGuid']
                     self.kb_server = auth_result['kbServer']
                     self.user_guid = auth_result.get('userGuid', self.username)
                     self.token_expiry = datetime.now() + timedelta(hours=24)
+                    self._update_token_cache()
                     
                     # 获取所有知识库列表
-                    self._get_kb_list()
+                    self._get_kb_list(preloaded_teams)
                     
                     # 保存Token
                     self._save_token()
@@ -185,8 +303,12 @@ class WizNoteAuth:
             logger.error(f"登录请求异常: {e}")
             return False
     
-    def _get_kb_list(self):
-        """获取所有知识库列表（个人+团队）"""
+    def _get_kb_list(self, preloaded_teams: Optional[List[Dict]] = None) -> None:
+        """获取所有知识库列表（个人+团队）
+        
+        Args:
+            preloaded_teams: 登录响应中已包含的团队知识库，提供时不再请求团队接口
+        """
         try:
             # 添加个人知识库
             self.kb_list = [{
@@ -198,57 +320,70 @@ class WizNoteAuth:
                 'bizGuid': None
             }]
             
+            if preloaded_teams is not None:
+                self.kb_list.extend(preloaded_teams)
+                logger.info(f"获取到 {len(self.kb_list)} 个知识库")
+                return
+            
             # 获取团队知识库列表
             # 根据文档，使用 /as/biz/user_kb_list API
             # 注意：此时登录已完成，可以使用token
             try:
                 # 先获取所有biz（企业/团队）
                 biz_url = f"{self.as_url}/as/api/biz/joined"
-                headers = {
-                    "X-Wiz-Token": self.token,
-                    "Content-Type": "application/json",
-                    "User-Agent": "WizNote-Team-Backup/1.0"
-                }
+                headers = self._headers_cache
                 
-                logger.debug(f"获取团队列表: {biz_url}")
-                response = requests.get(
+                logger.debug("获取团队列表: %s", biz_url)
+                response = self.session.get(
                     biz_url,
                     headers=headers,
                     timeout=self.config['api']['timeout']
                 )
                 
-                logger.debug(f"团队列表响应: {response.status_code}")
+                logger.debug("团队列表响应: %s", response.status_code)
                 if response.status_code == 200:
                     biz_result = response.json()
                     if biz_result.get('returnCode') == 200:
                         biz_list = biz_result.get('result', [])
                         
-                        # 对每个biz获取知识库
-                        for biz in biz_list:
+                        # 并发获取每个biz的知识库
+                        def fetch_kb(biz: Dict) -> Tuple[str, str, Optional[Dict]]:
                             biz_guid = biz.get('bizGuid')
                             biz_name = biz.get('bizName', 'Unknown')
                             
-                            # 获取该biz的知识库
-                            kb_url = f"{self.as_url}/as/biz/user_kb_list?bizGuid={biz_guid}"
-                            kb_response = requests.get(
-                                kb_url,
-                                headers=headers,  # 使用同样的headers
-                                timeout=self.config['api']['timeout']
-                            )
-                            
-                            if kb_response.status_code == 200:
-                                kb_result = kb_response.json()
-                                if kb_result.get('returnCode') == 200:
-                                    kb_info = kb_result.get('result', {})
-                                    if kb_info:
-                                        self.kb_list.append({
-                                            'kbGuid': kb_info.get('kbGuid'),
-                                            'kbServer': kb_info.get('kbServer'),
-                                            'name': f"{biz_name} - 团队笔记",
-                                            'type': 'team',
-                                            'bizName': biz_name,
-                                            'bizGuid': biz_guid
-                                        })
+                            kb_info = None
+                            try:
+                                kb_url = f"{self.as_url}/as/biz/user_kb_list?bizGuid={biz_guid}"
+                                kb_response = self.session.get(
+                                    kb_url,
+                                    headers=headers,  # 使用同样的headers
+                                    timeout=self.config['api']['timeout']
+                                )
+                                
+                                if kb_response.status_code == 200:
+                                    kb_result = kb_response.json()
+                                    if kb_result.get('returnCode') == 200:
+                                        kb_info = kb_result.get('result', {})
+                            except Exception as e:
+                                # 单个团队失败只跳过该团队
+                                logger.warning(f"获取团队知识库失败 {biz_name}: {e}")
+                            return biz_name, biz_guid, kb_info
+                        
+                        max_workers = self.config['api'].get('parallel', 5)
+                        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                            results = list(executor.map(fetch_kb, biz_list))
+                        
+                        # 在主线程中汇总，保持原有顺序
+                        for biz_name, biz_guid, kb_info in results:
+                            if kb_info:
+                                self.kb_list.append({
+                                    'kbGuid': kb_info.get('kbGuid'),
+                                    'kbServer': kb_info.get('kbServer'),
+                                    'name': f"{biz_name} - 团队笔记",
+                                    'type': 'team',
+                                    'bizName': biz_name,
+                                    'bizGuid': biz_guid
+                                })
             except Exception as e:
                 logger.warning(f"获取团队知识库失败: {e}")
             
@@ -268,22 +403,19 @@ class WizNoteAuth:
     
     def is_token_valid(self) -> bool:
         """检查Token是否有效"""
-        if not self.token or not self.token_expiry:
-            return False
-        
-        # 提前5分钟过期，避免边界情况
-        return datetime.now() < self.token_expiry - timedelta(minutes=5)
+        # 截止时间已预留5分钟余量，见 _update_token_cache
+        deadline = self._token_deadline
+        return self.token is not None and deadline is not None and time.monotonic() < deadline
     
     def get_headers(self) -> Dict[str, str]:
-        """获取请求头"""
+        """获取请求头
+
+        返回的是缓存的字典，调用方不应修改
+        """
         if not self.is_token_valid():
             self.refresh_token()
         
-        return {
-            "X-Wiz-Token": self.token,  # 根据官方文档使用X-Wiz-Token
-            "Content-Type": "application/json",
-            "User-Agent": "WizNote-Team-Backup/1.0"
-        }
+        return self._headers_cache
     
     def get_kb_info(self) -> Dict:
         """获取当前知识库信息"""
@@ -7,15 +7,80 @@
 
 import os
 import re
+import html
+import hashlib
 import logging
+import threading
 import html2text
 from typing import Dict, List, Tuple, Optional
 from bs4 import BeautifulSoup
 import base64
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 
+try:
+    import lxml  # noqa: F401
+    _HTML_PARSER = 'lxml'
+except ImportError:  # 未安装lxml时回退到纯Python解析器
+    _HTML_PARSER = 'html.parser'
+
 logger = logging.getLogger(__name__)
 
+# 转换逻辑或html2text配置变化时递增，使磁盘上的旧转换缓存失效
+CONVERTER_VERSION = 1
+
+# 预编译正则表达式
+_RE_BLANKS = re.compile(r'\n{3,}')
+_RE_NEWLINE_RUN = re.compile(r'\n{2,}')
+_RE_TRAILING_WS = re.compile(r'[^\S\n]+$', re.MULTILINE)
+_RE_HTML_TAG = re.compile(r'<[^>]+>')
+_RE_EMPTY_CODEBLK = re.compile(r'```\s*\n\s*```')
+_RE_DATA_URI = re.compile(r'data:image/(\w+);base64,(.+)')
+# Markdown笔记以HTML返回时：需整体丢弃的元素、转换为换行的标签
+_RE_NON_CONTENT = re.compile(r'<(head|title|style|script)\b[^>]*>.*?</\1\s*>', re.IGNORECASE | re.DOTALL)
+_RE_LINE_BREAK_TAG = re.compile(r'<br\s*/?>|</(?:div|p|li|h[1-6]|tr|pre|blockquote)\s*>', re.IGNORECASE)
+# img标签中带引号的base64图片src，在解析HTML之前直接替换
+_RE_IMG_DATA_URI = re.compile(r'((?i:<img\b[^>]*?\ssrc)\s*=\s*(["\']))data:image/(\w+);base64,([^"\']*)\2')
+
+# 预处理HTML时保留的属性
+_KEEP_ATTRS = frozenset(('href', 'src', 'alt', 'title'))
+
+
+def _collapse_newlines(match: re.Match) -> str:
+    """将连续空行压缩为一个，紧邻代码块标记的空行直接去掉"""
+    content = match.string
+    start, end = match.span()
+    if content.endswith('```', 0, start) or content.startswith('```', end):
+        return '\n'
+    return '\n\n'
+
+
+def _html_to_markdown_text(html_content: str) -> str:
+    """还原以HTML形式保存的Markdown原文（块级标签转为换行，去除标签后反转义实体）"""
+    text = _RE_NON_CONTENT.sub('', html_content)
+    text = _RE_LINE_BREAK_TAG.sub('\n', text)
+    text = _RE_HTML_TAG.sub('', text)
+    return html.unescape(text).replace('\xa0', ' ')
+
+
+def _build_yaml_frontmatter(note_info: Dict, with_author: bool = False) -> str:
+    """生成YAML前置元数据"""
+    created = note_info.get('created')
+    modified = note_info.get('modified')
+    tags = note_info.get('tags')
+    author = note_info.get('author') if with_author else None
+    
+    created_line = f"created: {created}\n" if created else ''
+    modified_line = f"modified: {modified}\n" if modified else ''
+    tags_line = ''
+    if tags:
+        tags_line = f"tags: [{', '.join(tags) if isinstance(tags, list) else tags}]\n"
+    author_line = f"author: {author}\n" if author else ''
+    
+    return (f"---\ntitle: {note_info.get('title', 'Untitled')}\n"
+            f"{created_line}{modified_line}{tags_line}{author_line}---\n")
+
 
 class HTMLToMarkdownConverter:
     """HTML到Markdown转换器"""
@@ -25,13 +90,24 @@ class HTMLToMarkdownConverter:
         self.extract_images = config['format']['extract_images']
         self.add_metadata = config['format']['add_metadata']
         
-        # 配置html2text
-        self.h2t = html2text.HTML2Text()
-        self.h2t.body_width = 0  # 不自动换行
-        self.h2t.protect_links = True  # 保护链接
-        self.h2t.unicode_snob = True  # 使用Unicode
-        self.h2t.images_to_alt = False  # 保留图片链接
-        self.h2t.single_line_break = True  # 单行换行
+        # 影响convert_content结果的版本和设置（元数据另行添加，不在其中），用作转换缓存键的一部分
+        self.cache_key = f"{CONVERTER_VERSION}|{_HTML_PARSER}|{int(self.extract_images)}".encode()
+        
+        # html2text实例在转换过程中会修改内部状态，每个线程单独使用一个
+        self._h2t_tls = threading.local()
+    
+    def _get_h2t(self) -> html2text.HTML2Text:
+        """获取当前线程的html2text实例（首次访问时创建并配置）"""
+        h2t = getattr(self._h2t_tls, 'h2t', None)
+        if h2t is None:
+            h2t = html2text.HTML2Text()
+            h2t.body_width = 0  # 不自动换行
+            h2t.protect_links = True  # 保护链接
+            h2t.unicode_snob = True  # 使用Unicode
+            h2t.images_to_alt = False  # 保留图片链接
+            h2t.single_line_break = True  # 单行换行
+            self._h2t_tls.h2t = h2t
+        return h2t
     
     def convert(self, html_content: str, note_info: Dict, 
                 resources: List[str]) -> Tuple[str, List[Dict]]:
@@ -46,21 +122,13 @@ class HTMLToMarkdownConverter:
             (markdown_content, updated_resources)
         """
         try:
-            # 预处理HTML
-            processed_html, extracted_resources = self._preprocess_html(
-                html_content, 
+            markdown_content, extracted_resources = self.convert_content(
+                html_content,
                 resources
             )
             
-            # 转换为Markdown
-            markdown_content = self.h2t.handle(processed_html)
-            
-            # 后处理Markdown
-            markdown_content = self._postprocess_markdown(markdown_content)
-            
             # 添加元数据
-            if self.add_metadata:
-                markdown_content = self._add_metadata(markdown_content, note_info)
+            markdown_content = self.apply_metadata(markdown_content, note_info)
             
             return markdown_content, extracted_resources
             
@@ -69,28 +137,67 @@ class HTMLToMarkdownConverter:
             # 返回原始内容的简单转换
             return f"# {note_info.get('title', 'Untitled')}\n\n转换失败，以下为原始HTML：\n\n```html\n{html_content}\n```", []
     
+    def convert_content(self, html_content: str, 
+                        resources: List[str]) -> Tuple[str, List[Dict]]:
+        """转换HTML正文到Markdown（不含元数据，转换失败时抛出异常）
+        
+        结果只取决于HTML内容，可按内容哈希缓存；元数据由apply_metadata另行添加
+        """
+        # 预处理HTML
+        processed_html, extracted_resources = self._preprocess_html(
+            html_content, 
+            resources
+        )
+        
+        # 转换为Markdown
+        markdown_content = self._get_h2t().handle(processed_html)
+        
+        # 后处理Markdown
+        markdown_content = self._postprocess_markdown(markdown_content)
+        
+        return markdown_content, extracted_resources
+    
     def _preprocess_html(self, html_content: str, 
                         resources: List[str]) -> Tuple[str, List[Dict]]:
         """预处理HTML内容"""
-        soup = BeautifulSoup(html_content, 'html.parser')
         extracted_resources = []
         
-        # 处理图片
-        if self.extract_images:
-            for img in soup.find_all('img'):
-                src = img.get('src', '')
+        # 先用正则把base64图片替换为本地路径，避免在DOM中处理大段data URI
+        if self.extract_images and 'data:image' in html_content:
+            def replace_data_uri(match: re.Match) -> str:
+                base64_data = match.group(4)
+                if '&' in base64_data:
+                    base64_data = html.unescape(base64_data)
+                resource_info = self._decode_base64_image(match.group(3), base64_data)
+                if not resource_info:
+                    return match.group(0)
+                extracted_resources.append(resource_info)
+                return f"{match.group(1)}./assets/{resource_info['filename']}{match.group(2)}"
+            
+            html_content = _RE_IMG_DATA_URI.sub(replace_data_uri, html_content)
+        
+        soup = BeautifulSoup(html_content, _HTML_PARSER)
+        
+        # 单次遍历所有标签，按标签类型分别处理
+        # find_all 返回的是列表，遍历过程中替换/包裹节点是安全的
+        for tag in soup.find_all(True):
+            name = tag.name
+            
+            # 处理图片
+            if name == 'img' and self.extract_images:
+                src = tag.get('src', '')
                 
-                # 处理base64图片
+                # 处理base64图片（未加引号等正则未覆盖的写法）
                 if src.startswith('data:image'):
                     resource_info = self._extract_base64_image(src)
                     if resource_info:
-                        img['src'] = f"./assets/{resource_info['filename']}"
+                        tag['src'] = f"./assets/{resource_info['filename']}"
                         extracted_resources.append(resource_info)
                 
                 # 处理本地图片路径
                 elif src.startswith('index_files/') or 'resources/' in src:
                     filename = os.path.basename(src)
-                    img['src'] = f"./assets/{filename}"
+                    tag['src'] = f"./assets/{filename}"
                     
                     # 检查是否在资源列表中
                     if filename in resources:
@@ -99,65 +206,61 @@ class HTMLToMarkdownConverter:
                             'type': 'resource',
                             'original_src': src
                         })
-        
-        # 处理代码块
-        for pre in soup.find_all('pre'):
-            # 检查是否有代码语言标记
-            code = pre.find('code')
-            if code:
-                # 获取语言类型
-                lang_class = code.get('class', [])
-                language = ''
-                for cls in lang_class:
-                    if cls.startswith('language-'):
-                        language = cls.replace('language-', '')
-                        break
-                
-                # 替换为Markdown代码块格式
-                code_text = code.get_text()
-                new_pre = soup.new_tag('pre')
-                new_pre.string = f"```{language}\n{code_text}\n```"
-                pre.replace_with(new_pre)
-        
-        # 处理表格
-        for table in soup.find_all('table'):
-            # 确保表格有正确的结构
-            if not table.find('thead'):
-                # 如果没有thead，尝试从第一行创建
-                first_row = table.find('tr')
-                if first_row:
-                    thead = soup.new_tag('thead')
-                    first_row.wrap(thead)
-        
-        # 清理多余的样式和属性
-        for tag in soup.find_all(True):
-            # 保留的属性
-            keep_attrs = ['href', 'src', 'alt', 'title']
-            attrs = dict(tag.attrs)
-            for attr in attrs:
-                if attr not in keep_attrs:
-                    del tag[attr]
+            
+            # 处理代码块（pre先于其子节点code被访问，此时code的class尚未清理）
+            elif name == 'pre':
+                code = tag.find('code')
+                if code:
+                    # 获取语言类型
+                    lang_class = code.get('class', [])
+                    language = ''
+                    for cls in lang_class:
+                        if cls.startswith('language-'):
+                            language = cls.replace('language-', '')
+                            break
+                    
+                    # 替换为Markdown代码块格式
+                    code_text = code.get_text()
+                    new_pre = soup.new_tag('pre')
+                    new_pre.string = f"```{language}\n{code_text}\n```"
+                    tag.replace_with(new_pre)
+                    continue
+            
+            # 处理表格
+            elif name == 'table':
+                # 确保表格有正确的结构
+                if not tag.find('thead'):
+                    # 如果没有thead，尝试从第一行创建
+                    first_row = tag.find('tr')
+                    if first_row:
+                        thead = soup.new_tag('thead')
+                        first_row.wrap(thead)
+            
+            # 清理多余的样式和属性（只有存在需删除的属性时才重建字典）
+            attrs = tag.attrs
+            if attrs and not _KEEP_ATTRS.issuperset(attrs):
+                tag.attrs = {k: v for k, v in attrs.items() if k in _KEEP_ATTRS}
         
         return str(soup), extracted_resources
     
     def _extract_base64_image(self, data_uri: str) -> Optional[Dict]:
         """提取base64编码的图片"""
+        # 解析data URI
+        match = _RE_DATA_URI.match(data_uri)
+        if not match:
+            return None
+        
+        return self._decode_base64_image(match.group(1), match.group(2))
+    
+    def _decode_base64_image(self, image_type: str, base64_data: str) -> Optional[Dict]:
+        """解码base64图片数据并生成资源信息"""
         try:
-            # 解析data URI
-            match = re.match(r'data:image/(\w+);base64,(.+)', data_uri)
-            if not match:
-                return None
-            
-            image_type = match.group(1)
-            base64_data = match.group(2)
-            
             # 解码base64
             image_data = base64.b64decode(base64_data)
             
-            # 生成文件名
-            import hashlib
-            hash_md5 = hashlib.md5(image_data).hexdigest()[:8]
-            filename = f"image_{hash_md5}.{image_type}"
+            # 生成文件名（4字节BLAKE2摘要即8位十六进制）
+            image_hash = hashlib.blake2b(image_data, digest_size=4).hexdigest()
+            filename = f"image_{image_hash}.{image_type}"
             
             return {
                 'filename': filename,
@@ -172,17 +275,11 @@ class HTMLToMarkdownConverter:
     
     def _postprocess_markdown(self, markdown_content: str) -> str:
         """后处理Markdown内容"""
-        # 清理多余的空行
-        markdown_content = re.sub(r'\n{3,}', '\n\n', markdown_content)
+        # 清理多余的空行，同时修复代码块格式（单次扫描）
+        markdown_content = _RE_NEWLINE_RUN.sub(_collapse_newlines, markdown_content)
         
-        # 修复代码块格式
-        markdown_content = re.sub(r'```\n\n', '```\n', markdown_content)
-        markdown_content = re.sub(r'\n\n```', '\n```', markdown_content)
-        
-        # 清理行首行尾空格
-        lines = markdown_content.split('\n')
-        lines = [line.rstrip() for line in lines]
-        markdown_content = '\n'.join(lines)
+        # 清理行尾空格（单次正则扫描，避免按行拆分再拼接）
+        markdown_content = _RE_TRAILING_WS.sub('', markdown_content)
         
         # 确保文件末尾有换行
         if not markdown_content.endswith('\n'):
@@ -190,65 +287,80 @@ class HTMLToMarkdownConverter:
         
         return markdown_content
     
+    def apply_metadata(self, markdown_content: str, note_info: Dict) -> str:
+        """按配置为convert_content的结果添加元数据"""
+        if self.add_metadata:
+            markdown_content = self._add_metadata(markdown_content, note_info)
+        return markdown_content
+    
     def _add_metadata(self, markdown_content: str, note_info: Dict) -> str:
         """添加YAML前置元数据"""
-        metadata = []
-        metadata.append("---")
-        metadata.append(f"title: {note_info.get('title', 'Untitled')}")
-        
-        if note_info.get('created'):
-            metadata.append(f"created: {note_info['created']}")
-        
-        if note_info.get('modified'):
-            metadata.append(f"modified: {note_info['modified']}")
-        
-        if note_info.get('tags'):
-            tags = note_info['tags']
-            if isinstance(tags, list):
-                metadata.append(f"tags: [{', '.join(tags)}]")
-            else:
-                metadata.append(f"tags: [{tags}]")
-        
-        if note_info.get('author'):
-            metadata.append(f"author: {note_info['author']}")
-        
-        metadata.append("---")
-        metadata.append("")
-        
-        return '\n'.join(metadata) + markdown_content
+        return _build_yaml_frontmatter(note_info, with_author=True) + markdown_content
     
-    def convert_batch(self, notes: List[Dict]) -> List[Dict]:
-        """批量转换笔记"""
-        results = []
+    def _convert_note(self, note: Dict) -> Dict:
+        """转换批量任务中的单个笔记"""
+        try:
+            html_content = note.get('html_content', '')
+            note_info = note.get('info', {})
+            resources = note.get('resources', [])
+            
+            markdown_content, extracted_resources = self.convert(
+                html_content,
+                note_info,
+                resources
+            )
+            
+            return {
+                'guid': note_info.get('guid'),
+                'markdown_content': markdown_content,
+                'extracted_resources': extracted_resources,
+                'success': True
+            }
+            
+        except Exception as e:
+            logger.error(f"批量转换失败 {note.get('title')}: {e}")
+            return {
+                'guid': note.get('guid'),
+                'error': str(e),
+                'success': False
+            }
+    
+    def convert_batch(self, notes: List[Dict], 
+                      max_workers: Optional[int] = None) -> List[Dict]:
+        """批量转换笔记
         
-        for note in notes:
-            try:
-                html_content = note.get('html_content', '')
-                note_info = note.get('info', {})
-                resources = note.get('resources', [])
-                
-                markdown_content, extracted_resources = self.convert(
-                    html_content,
-                    note_info,
-                    resources
-                )
-                
-                results.append({
-                    'guid': note_info.get('guid'),
-                    'markdown_content': markdown_content,
-                    'extracted_resources': extracted_resources,
-                    'success': True
-                })
-                
-            except Exception as e:
-                logger.error(f"批量转换失败 {note.get('title')}: {e}")
-                results.append({
-                    'guid': note.get('guid'),
-                    'error': str(e),
-                    'success': False
-                })
+        转换是CPU密集型操作，使用多进程并行，结果顺序与输入一致
+        """
+        if len(notes) < 2:
+            return [self._convert_note(note) for note in notes]
         
-        return results
+        try:
+            with ProcessPoolExecutor(
+                max_workers=max_workers or os.cpu_count(),
+                initializer=_init_batch_worker,
+                initargs=(type(self), self.config)
+            ) as executor:
+                return list(executor.map(_convert_in_worker, notes, chunksize=8))
+        except (OSError, NotImplementedError, BrokenProcessPool) as e:
+            # 当前环境不支持多进程时改用线程池
+            logger.warning(f"多进程转换不可用，改为多线程转换: {e}")
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                return list(executor.map(self._convert_note, notes))
+
+
+# 批量转换工作进程中的转换器实例
+_worker_converter = None
+
+
+def _init_batch_worker(converter_class: type, config: Dict):
+    """初始化批量转换工作进程"""
+    global _worker_converter
+    _worker_converter = converter_class(config)
+
+
+def _convert_in_worker(note: Dict) -> Dict:
+    """在工作进程中转换单个笔记"""
+    return _worker_converter._convert_note(note)
 
 
 class DirectMarkdownHandler:
@@ -269,16 +381,30 @@ class DirectMarkdownHandler:
         
         return markdown_content
     
+    def process_html(self, html_content: str, note_info: Dict) -> str:
+        """处理以HTML形式返回的Markdown笔记"""
+        markdown_content = self._tidy_markdown(_html_to_markdown_text(html_content))
+        
+        # 添加元数据
+        if self.add_metadata:
+            markdown_content = self._add_metadata(markdown_content, note_info)
+        
+        return markdown_content
+    
     def _clean_markdown(self, content: str) -> str:
         """清理Markdown内容"""
         # 移除可能的HTML标签
-        content = re.sub(r'<[^>]+>', '', content)
+        content = _RE_HTML_TAG.sub('', content)
         
+        return self._tidy_markdown(content)
+    
+    def _tidy_markdown(self, content: str) -> str:
+        """整理空行和代码块格式"""
         # 清理多余的空行
-        content = re.sub(r'\n{3,}', '\n\n', content)
+        content = _RE_BLANKS.sub('\n\n', content)
         
         # 确保代码块格式正确
-        content = re.sub(r'```\s*\n\s*```', '```\n```', content)
+        content = _RE_EMPTY_CODEBLK.sub('```\n```', content)
         
         return content.strip() + '\n'
     
@@ -289,27 +415,7 @@ class DirectMarkdownHandler:
             # 已有元数据，不重复添加
             return markdown_content
         
-        metadata = []
-        metadata.append("---")
-        metadata.append(f"title: {note_info.get('title', 'Untitled')}")
-        
-        if note_info.get('created'):
-            metadata.append(f"created: {note_info['created']}")
-        
-        if note_info.get('modified'):
-            metadata.append(f"modified: {note_info['modified']}")
-        
-        if note_info.get('tags'):
-            tags = note_info['tags']
-            if isinstance(tags, list):
-                metadata.append(f"tags: [{', '.join(tags)}]")
-            else:
-                metadata.append(f"tags: [{tags}]")
-        
-        metadata.append("---")
-        metadata.append("")
-        
-        return '\n'.join(metadata) + markdown_content
+        return _build_yaml_frontmatter(note_info) + markdown_content
 
 
 if __name__ == "__main__":
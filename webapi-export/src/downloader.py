@@ -7,8 +7,11 @@
 """
 
 import os
+import queue
+import hashlib
 import logging
-from typing import Dict, Optional, List
+import threading
+from typing import Dict, Optional, List, Tuple
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 import time
@@ -16,6 +19,33 @@ import re
 
 logger = logging.getLogger(__name__)
 
+# 预编译正则表达式
+_RE_IMG_SRC = re.compile(r'<img[^>]+src="([^"]+)"')
+
+# 待写入内嵌资源的队列上限，限制解码后图片占用的内存
+_RESOURCE_QUEUE_SIZE = 64
+
+# 笔记信息中互为别名的字段
+_NOTE_INFO_ALIASES = (('docGuid', 'guid'), ('dataModified', 'modified'))
+
+
+def _normalize_note_info(note_info: Dict):
+    """补全笔记信息中缺失的别名字段（已有的值不会被覆盖）"""
+    for key, alias in _NOTE_INFO_ALIASES:
+        if key in note_info:
+            note_info.setdefault(alias, note_info[key])
+        elif alias in note_info:
+            note_info[key] = note_info[alias]
+
+
+def _file_sha256(file_path: str) -> str:
+    """计算文件的SHA-256"""
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
 
 class NoteDownloader:
     """笔记下载器"""
@@ -25,6 +55,12 @@ class NoteDownloader:
         self.storage = storage
         self.converter = converter
         self.config = api_client.config
+        
+        # 已经是Markdown格式的笔记无需经过HTML转换
+        self.markdown_handler = None
+        if converter is not None:
+            from converter import DirectMarkdownHandler
+            self.markdown_handler = DirectMarkdownHandler(self.config)
         self.max_workers = self.config['download']['max_concurrent']
         self.kb_name = "Personal"  # 默认知识库名称
         
@@ -44,40 +80,124 @@ class NoteDownloader:
         
         # 失败记录
         self.failed_items = []
+        
+        # 下载清单 {note_guid: {version, modified, path, size, mtime_ns, sha256}}
+        self.manifest = {}
+        # 清单文件不随输出目录区分，只采用位于当前输出目录下的记录
+        self._output_prefix = os.path.join(os.path.abspath(storage.base_path), '')
+        
+        # 待下载的附件 [(note_guid, note_path, attachments)]，按文件夹批量下载
+        self._pending_attachments = []
+        # 待写入的内嵌资源队列 (note_path, filename, data)，由单独的写入线程保存
+        self._resource_queue = None
+        self._resource_writer = None
+        
+        # 线程池，在download_all中创建，所有文件夹共用
+        self._pool = None
+        self._attachment_pool = None
     
     def set_kb_name(self, kb_name: str):
         """设置知识库名称"""
         self.kb_name = kb_name
     
+    def set_manifest(self, manifest: Dict):
+        """设置下载清单"""
+        self.manifest = manifest
+    
+    def _manifest_entry(self, note_guid: str) -> Optional[Dict]:
+        """获取属于当前输出目录的清单记录"""
+        entry = self.manifest.get(note_guid)
+        if entry is None:
+            return None
+        path = entry.get('path')
+        if not path or not os.path.abspath(path).startswith(self._output_prefix):
+            return None
+        return entry
+    
+    def _is_unchanged_in_manifest(self, entry: Dict, note: Dict, modified_time: str) -> bool:
+        """根据下载清单判断笔记是否未变化且本地文件完好"""
+        if entry.get('version') != note.get('version') or entry.get('modified') != modified_time:
+            return False
+        
+        try:
+            st = os.stat(entry['path'])
+        except (OSError, KeyError):
+            return False
+        
+        # 快速路径：大小和修改时间一致
+        if st.st_size != entry.get('size'):
+            return False
+        if st.st_mtime_ns == entry.get('mtime_ns'):
+            return True
+        
+        # 仅修改时间不一致时再比较内容哈希
+        if _file_sha256(entry['path']) != entry.get('sha256'):
+            return False
+        entry['mtime_ns'] = st.st_mtime_ns
+        return True
+    
+    def _record_manifest(self, note_guid: str, version, modified_time: str, note_path):
+        """记录已下载笔记到下载清单"""
+        try:
+            st = os.stat(note_path)
+            self.manifest[note_guid] = {
+                'version': version,
+                'modified': modified_time,
+                'path': os.path.abspath(note_path),
+                'size': st.st_size,
+                'mtime_ns': st.st_mtime_ns,
+                'sha256': _file_sha256(note_path)
+            }
+        except OSError as e:
+            logger.warning(f"记录下载清单失败 {note_path}: {e}")
+    
     def download_all(self, folders_filter: Optional[List[str]] = None):
         """下载所有笔记"""
         self.stats['start_time'] = time.time()
         
         logger.info("开始备份笔记...")
         
-        # 获取所有文件夹
-        all_folders = self.api_client.get_all_folders()
-        
-        if not all_folders:
-            logger.warning("未找到任何文件夹")
-            return
-        
-        # 应用文件夹过滤
         if folders_filter:
-            folders_to_process = [f for f in all_folders if f in folders_filter]
+            # 已指定文件夹路径，无需获取完整的文件夹列表（去重并保持顺序）
+            folders_to_process = list(dict.fromkeys(folders_filter))
         else:
+            # 获取所有文件夹
+            all_folders = self.api_client.get_all_folders()
+            
+            if not all_folders:
+                logger.warning("未找到任何文件夹")
+                return
+            
             # 排除指定的文件夹
-            exclude_folders = self.config['sync']['exclude_folders']
+            exclude_folders = tuple(self.config['sync']['exclude_folders'])
             if exclude_folders:
-                folders_to_process = [f for f in all_folders if not any(f.startswith(ex) for ex in exclude_folders)]
+                folders_to_process = [f for f in all_folders if not f.startswith(exclude_folders)]
             else:
                 folders_to_process = all_folders
         
         logger.info(f"准备处理 {len(folders_to_process)} 个文件夹")
         
-        # 处理每个文件夹
-        for folder_path in folders_to_process:
-            self._download_folder(folder_path)
+        # 所有文件夹共用笔记和附件线程池
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._attachment_pool = ThreadPoolExecutor(max_workers=self.max_workers * 2)
+        self._resource_queue = queue.Queue(maxsize=_RESOURCE_QUEUE_SIZE)
+        self._resource_writer = threading.Thread(
+            target=self._write_resources,
+            name='resource-writer',
+            daemon=True
+        )
+        self._resource_writer.start()
+        try:
+            # 处理每个文件夹
+            for folder_path in folders_to_process:
+                self._download_folder(folder_path)
+        finally:
+            self._pool.shutdown()
+            self._resource_queue.put(None)
+            self._resource_writer.join()
+            self._attachment_pool.shutdown()
+            self._pool = self._attachment_pool = None
+            self._resource_queue = self._resource_writer = None
         
         self.stats['end_time'] = time.time()
         
@@ -115,7 +235,14 @@ class NoteDownloader:
                 note_guid = note.get('docGuid', note.get('guid', ''))
                 modified_time = note.get('dataModified', note.get('modified', ''))
                 
-                if not self.storage.is_note_modified(note_guid, modified_time):
+                # 有清单记录时以清单为准（同时校验本地文件），否则回退到索引
+                entry = self._manifest_entry(note_guid)
+                if entry is not None:
+                    unchanged = self._is_unchanged_in_manifest(entry, note, modified_time)
+                else:
+                    unchanged = not self.storage.is_note_modified(note_guid, modified_time)
+                
+                if unchanged:
                     logger.debug(f"跳过未修改的笔记: {note.get('title', 'Untitled')}")
                     self.stats['skipped_notes'] += 1
                     continue
@@ -128,35 +255,55 @@ class NoteDownloader:
         # 使用进度条
         with tqdm(total=len(notes_to_download), desc=f"下载 {folder_name}") as pbar:
             # 并发下载
-            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-                future_to_note = {
-                    executor.submit(
-                        self._download_note,
-                        folder_path,
-                        note
-                    ): note
-                    for note in notes_to_download
-                }
-                
-                for future in as_completed(future_to_note):
-                    note = future_to_note[future]
-                    try:
-                        success = future.result()
-                        if success:
-                            self.stats['downloaded_notes'] += 1
-                        else:
-                            self.stats['failed_notes'] += 1
-                    except Exception as e:
-                        logger.error(f"下载笔记失败 {note.get('title', 'Untitled')}: {e}")
+            future_to_note = {
+                self._pool.submit(
+                    self._download_note,
+                    folder_path,
+                    note
+                ): note
+                for note in notes_to_download
+            }
+            
+            for future in as_completed(future_to_note):
+                note = future_to_note[future]
+                try:
+                    success = future.result()
+                    if success:
+                        self.stats['downloaded_notes'] += 1
+                    else:
                         self.stats['failed_notes'] += 1
-                        self.failed_items.append({
-                            'type': 'note',
-                            'title': note.get('title', 'Untitled'),
-                            'guid': note.get('docGuid', note.get('guid', '')),
-                            'error': str(e)
-                        })
-                    finally:
-                        pbar.update(1)
+                except Exception as e:
+                    logger.error(f"下载笔记失败 {note.get('title', 'Untitled')}: {e}")
+                    self.stats['failed_notes'] += 1
+                    self.failed_items.append({
+                        'type': 'note',
+                        'title': note.get('title', 'Untitled'),
+                        'guid': note.get('docGuid', note.get('guid', '')),
+                        'error': str(e)
+                    })
+                finally:
+                    pbar.update(1)
+        
+        # 等待该文件夹中的内嵌资源全部写入
+        self._resource_queue.join()
+        
+        # 批量下载该文件夹中所有笔记的附件
+        pending, self._pending_attachments = self._pending_attachments, []
+        if pending:
+            self._download_attachments(pending, folder_name)
+    
+    def _write_resources(self):
+        """写入线程：依次保存队列中的内嵌资源，收到None时退出"""
+        while True:
+            item = self._resource_queue.get()
+            try:
+                if item is None:
+                    return
+                self.storage.save_resource(*item)
+            except Exception as e:
+                logger.error(f"保存内嵌资源失败 {item[1]}: {e}")
+            finally:
+                self._resource_queue.task_done()
     
     def _download_note(self, folder_path: str, note_info: Dict) -> bool:
         """下载单个笔记及其附件"""
@@ -164,6 +311,10 @@ class NoteDownloader:
             note_guid = note_info.get('docGuid', note_info.get('guid', ''))
             note_title = note_info.get('title', 'Untitled')
             
+            # 记录列表接口返回的版本信息，供下载清单比较
+            version = note_info.get('version')
+            modified_time = note_info.get('dataModified', note_info.get('modified', ''))
+            
             logger.debug(f"处理笔记: {note_title}, GUID: {note_guid}")
             logger.debug(f"笔记信息: {note_info}")
             
@@ -173,14 +324,7 @@ class NoteDownloader:
                 note_info.update(full_note_info)
                 
             # 标准化笔记信息中的关键字段
-            if 'docGuid' not in note_info and 'guid' in note_info:
-                note_info['docGuid'] = note_info['guid']
-            if 'guid' not in note_info and 'docGuid' in note_info:
-                note_info['guid'] = note_info['docGuid']
-            if 'dataModified' not in note_info and 'modified' in note_info:
-                note_info['dataModified'] = note_info['modified']
-            if 'modified' not in note_info and 'dataModified' in note_info:
-                note_info['modified'] = note_info['dataModified']
+            _normalize_note_info(note_info)
             
             # 下载笔记内容
             note_data = self.api_client.download_note(note_guid)
@@ -202,12 +346,21 @@ class NoteDownloader:
             
             # 转换内容
             if self.converter and self.config['format']['convert_to_markdown']:
-                # 转换为Markdown
-                markdown_content, extracted_resources = self.converter.convert(
-                    html_content,
-                    note_info,
-                    resources
-                )
+                if note_info.get('type') == 'md':
+                    # Markdown笔记的正文以HTML返回，还原原文后只做清理和添加元数据
+                    markdown_content = self.markdown_handler.process_html(html_content, note_info)
+                    extracted_resources = []
+                elif html_content.lstrip().startswith('---\n'):
+                    # 内容本身就是带前置元数据的Markdown
+                    markdown_content = self.markdown_handler.process(html_content, note_info)
+                    extracted_resources = []
+                else:
+                    # 转换为Markdown
+                    markdown_content, extracted_resources = self._convert_note_content(
+                        html_content,
+                        note_info,
+                        resources
+                    )
                 
                 # 保存笔记
                 note_path = self.storage.save_note(
@@ -218,15 +371,15 @@ class NoteDownloader:
                     'md'
                 )
                 
-                # 处理提取的资源（如base64图片）
+                # 处理提取的资源（如base64图片），交给写入线程保存，队列满时等待
                 if note_path and extracted_resources:
                     for resource in extracted_resources:
                         if resource.get('type') == 'base64' and resource.get('data'):
-                            self.storage.save_resource(
+                            self._resource_queue.put((
                                 note_path,
                                 resource['filename'],
                                 resource['data']
-                            )
+                            ))
             else:
                 # 保存原始HTML
                 note_path = self.storage.save_note(
@@ -243,70 +396,138 @@ class NoteDownloader:
             # 下载附件
             attachments = self.api_client.get_attachments(note_guid)
             if attachments and self.config['download']['download_attachments']:
-                self.stats['total_attachments'] += len(attachments)
-                self._download_attachments(note_guid, note_path, attachments)
+                # 附件在文件夹内所有笔记处理完后统一下载
+                self._pending_attachments.append((note_guid, note_path, attachments))
             
             # 下载资源（图片）- 从HTML中提取的
             if resources and self.config['format']['extract_images']:
                 self._download_resources(note_guid, note_path, resources)
             
+            self._record_manifest(note_guid, version, modified_time, note_path)
             return True
             
         except Exception as e:
             logger.error(f"下载笔记异常 {note_info.get('title', 'Untitled')}: {e}")
             return False
     
+    def _convert_note_content(self, html_content: str, note_info: Dict, 
+                              resources: List[str]) -> Tuple[str, List[Dict]]:
+        """转换笔记内容，HTML未变化时复用缓存的转换结果"""
+        hasher = hashlib.blake2b(digest_size=16)
+        # 转换结果还取决于转换器版本和相关设置
+        hasher.update(self.converter.cache_key)
+        hasher.update(b'\0')
+        hasher.update(html_content.encode('utf-8'))
+        html_hash = hasher.hexdigest()
+        
+        cached = self.storage.get_cached_markdown(html_hash)
+        if cached is not None:
+            markdown_content, extracted_resources = cached
+        else:
+            try:
+                markdown_content, extracted_resources = self.converter.convert_content(
+                    html_content,
+                    resources
+                )
+            except Exception:
+                # 转换失败时由convert生成回退内容，且不写入缓存
+                return self.converter.convert(html_content, note_info, resources)
+            self.storage.put_cached_markdown(html_hash, markdown_content, extracted_resources)
+        
+        # 元数据每次重新生成，缓存只保存正文
+        markdown_content = self.converter.apply_metadata(markdown_content, note_info)
+        
+        return markdown_content, extracted_resources
+    
     def _extract_resources_from_html(self, html_content: str) -> List[str]:
         """从HTML中提取资源链接"""
         resources = []
+        seen = set()
         
         # 匹配图片标签
-        img_pattern = r'<img[^>]+src="([^"]+)"'
-        for match in re.finditer(img_pattern, html_content):
+        for match in _RE_IMG_SRC.finditer(html_content):
             src = match.group(1)
             # 检查是否是内部资源（不是http/https/data:开头的）
             if not src.startswith(('http://', 'https://', 'data:')):
                 # 可能是相对路径的资源
-                resource_name = os.path.basename(src)
-                if resource_name and resource_name not in resources:
+                resource_name = src.rpartition('/')[2]
+                if resource_name and resource_name not in seen:
+                    seen.add(resource_name)
                     resources.append(resource_name)
         
         return resources
     
-    def _download_attachments(self, note_guid: str, note_path, attachments: List[Dict]):
-        """下载笔记的附件"""
-        for attachment in attachments:
-            try:
-                att_guid = attachment.get('guid', '')
+    def _download_attachments(self, pending: List[Tuple], folder_name: str):
+        """批量下载附件
+        
+        所有附件提交到同一个线程池并发下载，边下载边写入磁盘，统计信息在当前线程中更新
+        """
+        jobs = []
+        for note_guid, note_path, attachments in pending:
+            self.stats['total_attachments'] += len(attachments)
+            for attachment in attachments:
+                if attachment.get('guid', ''):
+                    jobs.append((note_guid, note_path, attachment))
+        
+        if not jobs:
+            return
+        
+        with tqdm(total=len(jobs), desc=f"附件 {folder_name}") as pbar:
+            future_to_job = {
+                self._attachment_pool.submit(
+                    self._download_attachment,
+                    note_guid,
+                    note_path,
+                    attachment
+                ): (note_guid, note_path, attachment)
+                for note_guid, note_path, attachment in jobs
+            }
+            
+            for future in as_completed(future_to_job):
+                note_guid, note_path, attachment = future_to_job[future]
                 att_name = attachment.get('name', 'attachment')
-                
-                if not att_guid:
-                    continue
-                
-                # 下载附件内容
-                content = self.api_client.download_attachment(note_guid, att_guid)
-                
-                if content:
-                    # 保存附件
-                    self.storage.save_attachment(
-                        note_path,
-                        att_name,
-                        content
-                    )
-                    self.stats['downloaded_attachments'] += 1
-                    self.stats['total_size'] += len(content)
-                else:
-                    self.stats['failed_attachments'] += 1
+                try:
+                    size = future.result()
                     
-            except Exception as e:
-                logger.error(f"下载附件失败 {attachment.get('name', 'attachment')}: {e}")
-                self.stats['failed_attachments'] += 1
-                self.failed_items.append({
-                    'type': 'attachment',
-                    'name': attachment.get('name', 'attachment'),
-                    'note_guid': note_guid,
-                    'error': str(e)
-                })
+                    if size is not None:
+                        self.stats['downloaded_attachments'] += 1
+                        self.stats['total_size'] += size
+                    else:
+                        self.stats['failed_attachments'] += 1
+                        
+                except Exception as e:
+                    logger.error(f"下载附件失败 {att_name}: {e}")
+                    self.stats['failed_attachments'] += 1
+                    self.failed_items.append({
+                        'type': 'attachment',
+                        'name': att_name,
+                        'note_guid': note_guid,
+                        'error': str(e)
+                    })
+                finally:
+                    pbar.update(1)
+    
+    def _download_attachment(self, note_guid: str, note_path, 
+                             attachment: Dict) -> Optional[int]:
+        """下载并保存单个附件，返回写入的字节数，失败返回None"""
+        chunks = self.api_client.download_attachment(
+            note_guid,
+            attachment['guid'],
+            stream=True
+        )
+        if chunks is None:
+            return None
+        
+        try:
+            saved = self.storage.save_attachment_stream(
+                note_path,
+                attachment.get('name', 'attachment'),
+                chunks
+            )
+        finally:
+            # 写入失败时数据可能未读完，确保释放连接
+            chunks.close()
+        return saved[1] if saved else None
     
     def _download_resources(self, note_guid: str, note_path, resources: List[str]):
         """下载笔记的资源（图片等）
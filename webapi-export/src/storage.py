@@ -7,30 +7,116 @@
 
 import os
 import json
+import base64
 import shutil
+import threading
+import time
+from functools import lru_cache
 from pathlib import Path
 from datetime import datetime
-from typing import Dict, Optional, List
+from typing import Dict, Optional, List, Tuple, Iterable
 import logging
 import re
 
+try:
+    import orjson
+except ImportError:  # 未安装orjson时回退到标准库json
+    orjson = None
+
 logger = logging.getLogger(__name__)
 
 
+def _json_dumps(obj, indent: bool = True) -> bytes:
+    """序列化为JSON字节串（indent为False时输出单行，用于JSONL）"""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option)
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None).encode('utf-8')
+
+
+# 独占创建文件的标志（Windows下需要O_BINARY避免换行转换）
+_EXCL_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+
+
+def _write_all(fd: int, data: bytes):
+    """通过os.write将数据完整写入文件描述符，处理部分写入"""
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+def _json_loads(data: bytes):
+    """从JSON字节串反序列化"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# Windows文件名非法字符替换表
+_ILLEGAL_CHARS_TABLE = str.maketrans(dict.fromkeys('<>:"|?*\r\n\t', '_'))
+
+
+@lru_cache(maxsize=4096)
+def _sanitize_filename(filename: str) -> str:
+    """清理文件名，移除非法字符（团队名、文件夹名会反复出现，缓存结果）"""
+    filename = filename.translate(_ILLEGAL_CHARS_TABLE)
+    
+    # 移除前后空格和点
+    filename = filename.strip(' .')
+    
+    # 限制长度
+    name, ext = os.path.splitext(filename)
+    if len(name) > 200:
+        name = name[:200]
+    
+    return name + ext
+
+
+@lru_cache(maxsize=2048)
+def _sanitized_folder_parts(folder_path: str) -> Tuple[str, ...]:
+    """将文件夹路径拆分为清理后的各级目录名"""
+    return tuple(_sanitize_filename(part) 
+                 for part in folder_path.strip('/').split('/') 
+                 if part)
+
+
 class LocalStorage:
     """本地存储管理器"""
     
-    def __init__(self, base_path: str, preserve_structure: bool = True):
+    def __init__(self, base_path: str, preserve_structure: bool = True,
+                 md_cache_size: int = 5000):
         self.base_path = Path(base_path)
         self.preserve_structure = preserve_structure
         self.metadata_dir = self.base_path / '_metadata'
+        self._team_paths = {}
+        # 已确认存在的目录，避免重复mkdir
+        self._ensured_dirs = set()
+        # 各附件目录中已占用的文件名（首次写入时从磁盘加载），处理重名时免去逐个尝试
+        self._dir_names = {}
+        self._dir_names_lock = threading.Lock()
+        # 保存时间字符串缓存（单调时钟时间, ISO时间），每秒最多格式化一次
+        self._saved_at_cache = (float('-inf'), '')
+        
+        # Markdown转换结果缓存（按HTML内容哈希存储，按条目数做LRU淘汰）
+        self.md_cache_dir = self.metadata_dir / 'md_cache'
+        self.md_cache_size = md_cache_size
+        self._md_cache_count = None
+        self._md_cache_lock = threading.Lock()
         
         # 创建基础目录
         self.base_path.mkdir(parents=True, exist_ok=True)
         self.metadata_dir.mkdir(exist_ok=True)
         
-        # 笔记索引
+        # 笔记索引，index.json为完整快照，index.log按行追加之后的更新
         self.note_index = {}
+        # 文件路径到笔记GUID的反向索引
+        self._path_to_guid = {}
+        self._index_log = None
+        self._index_lock = threading.Lock()
+        self._closed = False
         self.load_index()
     
     def load_index(self):
@@ -38,43 +124,86 @@ class LocalStorage:
         index_file = self.metadata_dir / 'index.json'
         if index_file.exists():
             try:
-                with open(index_file, 'r', encoding='utf-8') as f:
-                    self.note_index = json.load(f)
+                self.note_index = _json_loads(index_file.read_bytes())
                 logger.info(f"加载了 {len(self.note_index)} 条索引记录")
             except Exception as e:
                 logger.error(f"加载索引失败: {e}")
                 self.note_index = {}
+        
+        # 重放上次未合并的增量记录
+        log_file = self.metadata_dir / 'index.log'
+        if log_file.exists():
+            replayed = 0
+            with open(log_file, 'rb') as f:
+                for line in f:
+                    try:
+                        self.note_index.update(_json_loads(line))
+                        replayed += 1
+                    except ValueError:
+                        # 异常退出时最后一行可能不完整
+                        logger.warning(f"跳过损坏的索引日志记录: {line[:80]!r}")
+            if replayed:
+                logger.info(f"重放了 {replayed} 条索引日志记录")
+        
+        self._path_to_guid = {}
+        for guid, info in self.note_index.items():
+            file_path = info.get('file_path')
+            if file_path:
+                self._path_to_guid.setdefault(file_path, guid)
+    
+    def _append_index_log(self, note_guid: str, entry: Dict):
+        """追加单条索引更新到index.log"""
+        line = _json_dumps({note_guid: entry}, indent=False) + b'\n'
+        with self._index_lock:
+            if self._index_log is None:
+                self._index_log = open(self.metadata_dir / 'index.log', 'ab', buffering=1 << 20)
+            self._index_log.write(line)
     
     def save_index(self):
-        """保存笔记索引"""
+        """保存笔记索引（写入完整快照并清空增量日志）"""
         index_file = self.metadata_dir / 'index.json'
+        tmp_file = index_file.with_name('index.json.tmp')
         try:
-            with open(index_file, 'w', encoding='utf-8') as f:
-                json.dump(self.note_index, f, ensure_ascii=False, indent=2)
+            with self._index_lock:
+                tmp_file.write_bytes(_json_dumps(self.note_index))
+                os.replace(tmp_file, index_file)
+                
+                # 快照已包含所有更新，清空增量日志
+                if self._index_log is not None:
+                    self._index_log.close()
+                    self._index_log = None
+                log_file = self.metadata_dir / 'index.log'
+                if log_file.exists():
+                    log_file.unlink()
         except Exception as e:
             logger.error(f"保存索引失败: {e}")
     
+    def close(self):
+        """合并索引并关闭日志文件"""
+        if self._closed:
+            return
+        self.save_index()
+        self._closed = True
+    
     def sanitize_filename(self, filename: str) -> str:
         """清理文件名，移除非法字符"""
-        # Windows文件名非法字符
-        illegal_chars = '<>:"|?*\r\n\t'
-        for char in illegal_chars:
-            filename = filename.replace(char, '_')
-        
-        # 移除前后空格和点
-        filename = filename.strip(' .')
-        
-        # 限制长度
-        name, ext = os.path.splitext(filename)
-        if len(name) > 200:
-            name = name[:200]
-        
-        return name + ext
+        return _sanitize_filename(filename)
+    
+    def _ensure_dir(self, path: Path):
+        """确保目录存在（每个目录只调用一次mkdir）"""
+        key = str(path)
+        if key in self._ensured_dirs:
+            return
+        path.mkdir(parents=True, exist_ok=True)
+        self._ensured_dirs.add(key)
     
     def get_team_path(self, team_name: str) -> Path:
         """获取团队目录路径"""
-        safe_name = self.sanitize_filename(team_name)
-        return self.base_path / safe_name
+        team_path = self._team_paths.get(team_name)
+        if team_path is None:
+            safe_name = self.sanitize_filename(team_name)
+            team_path = self._team_paths[team_name] = self.base_path / safe_name
+        return team_path
     
     def get_note_path(self, team_name: str, folder_path: str, 
                       note_title: str, note_guid: str) -> Path:
@@ -83,16 +212,13 @@ class LocalStorage:
         
         if self.preserve_structure and folder_path:
             # 保持原始文件夹结构
-            folder_parts = [self.sanitize_filename(part) 
-                          for part in folder_path.strip('/').split('/') 
-                          if part]
-            note_dir = team_path / Path(*folder_parts)
+            note_dir = team_path.joinpath(*_sanitized_folder_parts(folder_path))
         else:
             # 扁平化存储
             note_dir = team_path
         
         # 创建目录
-        note_dir.mkdir(parents=True, exist_ok=True)
+        self._ensure_dir(note_dir)
         
         # 生成文件名
         safe_title = self.sanitize_filename(note_title)
@@ -113,10 +239,16 @@ class LocalStorage:
     
     def get_note_guid_by_path(self, file_path: str) -> Optional[str]:
         """根据文件路径获取笔记GUID"""
-        for guid, info in self.note_index.items():
-            if info.get('file_path') == file_path:
-                return guid
-        return None
+        return self._path_to_guid.get(file_path)
+    
+    def _now_iso(self) -> str:
+        """获取当前时间的ISO字符串（1秒内复用同一个值）"""
+        checked_at, value = self._saved_at_cache
+        now = time.monotonic()
+        if now - checked_at >= 1.0:
+            value = datetime.now().isoformat()
+            self._saved_at_cache = (now, value)
+        return value
     
     def save_note(self, team_name: str, folder_path: str, note: Dict, 
                   content: str, format: str = 'md') -> Optional[Path]:
@@ -131,11 +263,11 @@ class LocalStorage:
             )
             
             # 保存内容
-            with open(file_path, 'w', encoding='utf-8') as f:
+            with open(file_path, 'w', encoding='utf-8', buffering=1 << 20) as f:
                 f.write(content)
             
             # 更新索引
-            self.note_index[note['guid']] = {
+            entry = {
                 'title': note['title'],
                 'file_path': str(file_path),
                 'team': team_name,
@@ -144,8 +276,16 @@ class LocalStorage:
                 'modified': note.get('modified'),
                 'tags': note.get('tags', []),
                 'format': format,
-                'saved_at': datetime.now().isoformat()
+                'saved_at': self._now_iso()
             }
+            old_entry = self.note_index.get(note['guid'])
+            if old_entry and old_entry.get('file_path') != entry['file_path']:
+                # 笔记路径变化时移除旧路径的映射
+                if self._path_to_guid.get(old_entry.get('file_path')) == note['guid']:
+                    del self._path_to_guid[old_entry['file_path']]
+            self.note_index[note['guid']] = entry
+            self._path_to_guid[entry['file_path']] = note['guid']
+            self._append_index_log(note['guid'], entry)
             
             logger.info(f"保存笔记: {file_path}")
             return file_path
@@ -165,23 +305,17 @@ class LocalStorage:
         try:
             # 创建附件目录
             attachment_dir = self.get_attachment_dir(note_path)
-            attachment_dir.mkdir(exist_ok=True)
+            self._ensure_dir(attachment_dir)
             
             # 清理文件名
             safe_name = self.sanitize_filename(attachment_name)
-            attachment_path = attachment_dir / safe_name
-            
-            # 处理重名
-            if attachment_path.exists():
-                name, ext = os.path.splitext(safe_name)
-                counter = 1
-                while attachment_path.exists():
-                    attachment_path = attachment_dir / f"{name}_{counter}{ext}"
-                    counter += 1
             
             # 保存文件
-            with open(attachment_path, 'wb') as f:
-                f.write(content)
+            fd, attachment_path = self._create_unique(attachment_dir, safe_name)
+            try:
+                _write_all(fd, content)
+            finally:
+                os.close(fd)
             
             logger.info(f"保存附件: {attachment_path}")
             return attachment_path
@@ -190,19 +324,172 @@ class LocalStorage:
             logger.error(f"保存附件失败 {attachment_name}: {e}")
             return None
     
+    def save_attachment_stream(self, note_path: Path, attachment_name: str, 
+                               chunks: Iterable[bytes]) -> Optional[Tuple[Path, int]]:
+        """流式保存附件，返回(附件路径, 写入字节数)"""
+        try:
+            # 创建附件目录
+            attachment_dir = self.get_attachment_dir(note_path)
+            self._ensure_dir(attachment_dir)
+            
+            # 清理文件名
+            safe_name = self.sanitize_filename(attachment_name)
+            
+            # 边接收边写入
+            fd, attachment_path = self._create_unique(attachment_dir, safe_name)
+            size = 0
+            try:
+                with open(fd, 'wb', buffering=1 << 20) as f:
+                    for chunk in chunks:
+                        if chunk:
+                            f.write(chunk)
+                            size += len(chunk)
+            except BaseException:
+                # 删除写了一半的文件
+                attachment_path.unlink(missing_ok=True)
+                raise
+            
+            logger.info(f"保存附件: {attachment_path}")
+            return attachment_path, size
+            
+        except Exception as e:
+            logger.error(f"保存附件失败 {attachment_name}: {e}")
+            return None
+    
+    def _names_in(self, directory: Path) -> set:
+        """获取目录中已占用的文件名集合（需持有_dir_names_lock）"""
+        key = str(directory)
+        names = self._dir_names.get(key)
+        if names is None:
+            try:
+                names = set(os.listdir(directory))
+            except FileNotFoundError:
+                names = set()
+            self._dir_names[key] = names
+        return names
+    
+    def _create_unique(self, directory: Path, filename: str) -> Tuple[int, Path]:
+        """以独占方式创建文件，重名时添加数字后缀，返回(文件描述符, 路径)
+        
+        先按内存中的文件名集合跳过已占用的名称，最终仍以O_EXCL创建结果为准
+        """
+        name, ext = os.path.splitext(filename)
+        candidate = filename
+        counter = 1
+        while True:
+            with self._dir_names_lock:
+                names = self._names_in(directory)
+                while candidate in names:
+                    candidate = f"{name}_{counter}{ext}"
+                    counter += 1
+                names.add(candidate)
+            
+            path = directory / candidate
+            try:
+                return os.open(path, _EXCL_FLAGS, 0o644), path
+            except FileExistsError:
+                # 集合之外的同名文件（如大小写不敏感的文件系统），已记入集合，继续尝试
+                continue
+            except BaseException:
+                with self._dir_names_lock:
+                    names.discard(candidate)
+                raise
+    
     def save_resource(self, note_path: Path, resource_name: str, 
                      content: bytes) -> Optional[Path]:
         """保存资源（图片等）"""
         # 资源也保存在assets目录
         return self.save_attachment(note_path, resource_name, content)
     
+    def get_cached_markdown(self, html_hash: str) -> Optional[Tuple[str, List[Dict]]]:
+        """获取缓存的Markdown转换结果，未命中返回None"""
+        cache_file = self.md_cache_dir / f"{html_hash}.json"
+        try:
+            cached = _json_loads(cache_file.read_bytes())
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"读取转换缓存失败 {cache_file}: {e}")
+            return None
+        
+        # 更新访问时间，供LRU淘汰使用
+        try:
+            os.utime(cache_file)
+        except OSError:
+            pass
+        
+        resources = cached.get('resources', [])
+        for resource in resources:
+            if 'data' in resource:
+                resource['data'] = base64.b64decode(resource['data'])
+        return cached['markdown'], resources
+    
+    def put_cached_markdown(self, html_hash: str, markdown_content: str, 
+                            resources: List[Dict]):
+        """缓存Markdown转换结果"""
+        if self.md_cache_size <= 0:
+            return
+        
+        cached_resources = []
+        for resource in resources:
+            resource = dict(resource)
+            if isinstance(resource.get('data'), bytes):
+                resource['data'] = base64.b64encode(resource['data']).decode('ascii')
+            cached_resources.append(resource)
+        
+        cache_file = self.md_cache_dir / f"{html_hash}.json"
+        try:
+            self._ensure_dir(self.md_cache_dir)
+            is_new = not cache_file.exists()
+            tmp_file = cache_file.with_name(f"{cache_file.name}.{threading.get_ident()}.tmp")
+            tmp_file.write_bytes(_json_dumps(
+                {'markdown': markdown_content, 'resources': cached_resources},
+                indent=False
+            ))
+            os.replace(tmp_file, cache_file)
+        except Exception as e:
+            logger.warning(f"写入转换缓存失败 {cache_file}: {e}")
+            return
+        
+        if is_new:
+            self._evict_markdown_cache()
+    
+    def _evict_markdown_cache(self):
+        """缓存条目超出上限时淘汰最久未使用的条目"""
+        with self._md_cache_lock:
+            if self._md_cache_count is None:
+                self._md_cache_count = sum(
+                    1 for entry in os.scandir(self.md_cache_dir)
+                    if entry.name.endswith('.json')
+                )
+            else:
+                self._md_cache_count += 1
+            
+            if self._md_cache_count <= self.md_cache_size:
+                return
+            
+            entries = [
+                (entry.stat().st_mtime_ns, entry.path)
+                for entry in os.scandir(self.md_cache_dir)
+                if entry.name.endswith('.json')
+            ]
+            entries.sort()
+            # 一次多淘汰一部分，避免每次写入都扫描目录
+            keep = self.md_cache_size * 9 // 10
+            for _, path in entries[:len(entries) - keep]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._md_cache_count = min(len(entries), keep)
+            logger.debug(f"转换缓存淘汰后剩余 {self._md_cache_count} 条")
+    
     def get_sync_state(self) -> Dict:
         """获取同步状态"""
         sync_file = self.metadata_dir / 'sync_state.json'
         if sync_file.exists():
             try:
-                with open(sync_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
+                return _json_loads(sync_file.read_bytes())
             except Exception as e:
                 logger.error(f"加载同步状态失败: {e}")
         
@@ -216,17 +503,16 @@ class LocalStorage:
         """保存同步状态"""
         sync_file = self.metadata_dir / 'sync_state.json'
         try:
-            with open(sync_file, 'w', encoding='utf-8') as f:
-                json.dump(state, f, ensure_ascii=False, indent=2)
+            sync_file.write_bytes(_json_dumps(state))
         except Exception as e:
             logger.error(f"保存同步状态失败: {e}")
     
     def is_note_modified(self, note_guid: str, modified_time: str) -> bool:
         """检查笔记是否被修改"""
-        if note_guid not in self.note_index:
+        saved_info = self.note_index.get(note_guid)
+        if saved_info is None:
             return True  # 新笔记
         
-        saved_info = self.note_index[note_guid]
         saved_modified = saved_info.get('modified')
         
         if not saved_modified:
@@ -246,13 +532,23 @@ class LocalStorage:
                 teams[team] = 0
             teams[team] += 1
         
-        # 计算存储大小
+        # 计算存储大小（不含转换缓存）
         total_size = 0
         file_count = 0
-        for path in self.base_path.rglob('*'):
-            if path.is_file():
-                total_size += path.stat().st_size
-                file_count += 1
+        md_cache_path = str(self.md_cache_dir)
+        stack = [str(self.base_path)]
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.path != md_cache_path:
+                                stack.append(entry.path)
+                        elif entry.is_file():
+                            total_size += entry.stat().st_size
+                            file_count += 1
+            except OSError as e:
+                logger.warning(f"统计目录失败: {e}")
         
         return {
             'total_notes': total_notes,
@@ -264,17 +560,50 @@ class LocalStorage:
     
     def cleanup_empty_dirs(self):
         """清理空目录"""
-        for dirpath, dirnames, filenames in os.walk(self.base_path, topdown=False):
-            if not dirnames and not filenames and dirpath != str(self.base_path):
+        # 目录可能被删除，之后需要重新创建
+        self._ensured_dirs.clear()
+        with self._dir_names_lock:
+            self._dir_names.clear()
+        
+        # 自底向上遍历，在父目录中删除已确认为空的子目录，子目录删光后父目录也随之删除
+        # 支持时使用os.fwalk，按父目录文件描述符删除，省去逐级解析路径
+        base = str(self.base_path)
+        metadata_path = str(self.metadata_dir)
+        if hasattr(os, 'fwalk') and os.rmdir in os.supports_dir_fd:
+            walker = os.fwalk(base, topdown=False)
+        else:
+            walker = ((dirpath, dirnames, filenames, None)
+                      for dirpath, dirnames, filenames in os.walk(base, topdown=False))
+        
+        empty_dirs = set()
+        for dirpath, dirnames, filenames, dirfd in walker:
+            removed = 0
+            for name in dirnames:
+                child = os.path.join(dirpath, name)
+                if child not in empty_dirs:
+                    continue
                 try:
-                    os.rmdir(dirpath)
-                    logger.debug(f"删除空目录: {dirpath}")
+                    if dirfd is None:
+                        os.rmdir(child)
+                    else:
+                        os.rmdir(name, dir_fd=dirfd)
+                    removed += 1
+                    logger.debug(f"删除空目录: {child}")
                 except Exception as e:
-                    logger.error(f"删除目录失败 {dirpath}: {e}")
+                    logger.error(f"删除目录失败 {child}: {e}")
+            # 元数据目录保留，索引保存时需要
+            if not filenames and removed == len(dirnames) and dirpath != metadata_path:
+                empty_dirs.add(dirpath)
     
     def __del__(self):
         """析构时保存索引"""
-        self.save_index()
+        # 初始化失败或解释器退出阶段不再写文件
+        if not hasattr(self, '_closed'):
+            return
+        try:
+            self.close()
+        except Exception:
+            pass
 
 
 if __name__ == "__main__":